@@ -19,14 +19,33 @@
 
 import argparse
 import codecs
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import json
 import os
 import re
-import subprocess
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import traceback
 import unicodedata
 
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 from greekutils import beta2unicode
 
+import lxxm_index
+import lxxm_store
+
+# Where the corpus sink finds the tag table it shares with the NLTK corpus
+# builders
+morphtags_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'sblgnt-nltk')
+
 
 readme = """
 The accompanying files are distributed by the Center for Computer
@@ -108,66 +127,605 @@ texts = ["01.Gen.1.mlxx",
          "63.SusOG.mlxx",
          "64.SusTh.mlxx"]
 
+# Source files holding the two halves of a book, and the book they make up
+split_books = {"01.Gen.1.mlxx": "Gen",
+               "02.Gen.2.mlxx": "Gen",
+               "28.Psalms1.mlxx": "Psalms",
+               "29.Psalms2.mlxx": "Psalms",
+               "50.Isaiah1.mlxx": "Isaiah",
+               "51.Isaiah2.mlxx": "Isaiah",
+               "52.Jer1.mlxx": "Jer",
+               "53.Jer2.mlxx": "Jer",
+               "57.Ezek1.mlxx": "Ezek",
+               "58.Ezek2.mlxx": "Ezek"}
+
+patch_file = "lxxm-corrections.patch"
+manifest_file = "build/manifest.json"
+store_file = "lxxm-store.bin"
+
 beta_pat = r"[A-Z\\\(\)\*\|\+=/'#-]{,25}"
 verse_pat = re.compile(r'^[\w/]+ ?(?P<chapter>\d{1,3})?:?(?P<verse>\d{1,3})?')
 word_pat = re.compile(r"^(?P<word>" + beta_pat +
                       r")\s*(?P<morph>[\w \+/]{10})\s+(?P<root>("
                       + beta_pat + r"\s*)+)$")
 
+# Characters allowed in the word, morph and root columns, for split_columns
+beta_chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZ\\()*|+=/'#-"
+morph_chars = ("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+               "0123456789_ +/")
+root_chars = beta_chars + " \t\n\r\f\v"
+
+# Size of the output buffer used by write_lines
+write_buffer = 1 << 16
+
+# Redirects followed by Fetcher, and how many in a row
+redirect_codes = (301, 302, 303, 307, 308)
+max_redirects = 5
+
+# Files timed by the bench command unless others are given
+bench_texts = ["01.Gen.1.mlxx", "02.Gen.2.mlxx",
+               "28.Psalms1.mlxx", "29.Psalms2.mlxx"]
+
+
+def file_hash(path):
+    "Return the SHA-256 hex digest of the contents of the file at path"
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_version():
+    "Return a hash of this script, which changes whenever the conversion does"
+
+    return file_hash(os.path.abspath(__file__))
+
+
+def load_manifest():
+    """Return the build manifest left by the last run.
+
+    The manifest records content hashes of the source files and of the
+    inputs and outputs of each conversion, so that a rerun only redoes the
+    work whose inputs changed.
+    """
+
+    manifest = {"sources": {}, "converted": {}, "books": {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest.update(json.load(f))
+    return manifest
+
+
+def save_manifest(manifest):
+    "Write the build manifest"
+
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def book_files():
+    """Return the name of each output book, in order, with its source files.
+
+    Books split over two source files are combined, and the books are
+    numbered in canonical order.
+    """
+
+    books = collections.OrderedDict()
+    for text in texts:
+        name = split_books.get(text, text.split(".")[1])
+        books.setdefault(name, []).append(text)
+    return collections.OrderedDict(
+        ("{:0>2}.{}.txt".format(i, name), parts)
+        for i, (name, parts) in enumerate(books.items(), 1))
+
+
+def build_path(text):
+    "Return the path of the converted, but not yet combined, source file"
+
+    return "build/" + text.rsplit(".", 1)[0] + ".txt"
+
+
+def refs_path(text):
+    "Return the path of the verse references of a converted source file"
+
+    return "build/" + text.rsplit(".", 1)[0] + ".refs.json"
+
+
+def join_files(paths, out_path):
+    """Join the files at paths into out_path, byte for byte.
+
+    Nothing is decoded: the kernel copies the data with sendfile where it
+    can. The result goes to a temporary file that then replaces out_path,
+    so readers never see a half-written book.
+    """
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as o:
+        for path in paths:
+            with open(path, "rb") as part:
+                size = os.fstat(part.fileno()).st_size
+                offset = 0
+                try:
+                    while offset < size:
+                        sent = os.sendfile(o.fileno(), part.fileno(), offset,
+                                           size - offset)
+                        if not sent:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    # No sendfile between files here, copy the rest instead
+                    part.seek(offset)
+                    o.seek(0, os.SEEK_END)
+                    shutil.copyfileobj(part, o, 1 << 16)
+                    o.flush()
+    os.replace(tmp_path, out_path)
+
+
+def rename(manifest):
+    """Combine and rename the books
+
+    The name and number of each book are known up front from book_files,
+    and the halves of split books are joined straight into their final
+    file. Only books whose converted source files changed since the last
+    run are written again. Returns the source files that have not been
+    converted yet, without writing anything if there are any.
+    """
+
+    missing = [text for text in texts if text not in manifest["converted"]
+               or not os.path.exists(build_path(text))]
+    if missing:
+        return missing
+    os.makedirs('out', exist_ok=True)
+    for book, parts in book_files().items():
+        key = "|".join(manifest["converted"][text]["sha256"]
+                       for text in parts)
+        if (manifest["books"].get(book) == key and
+                os.path.exists('out/' + book)):
+            continue
+        print('out/' + book)
+        join_files([build_path(text) for text in parts], 'out/' + book)
+        manifest["books"][book] = key
+    write_index(manifest)
+    return []
+
+
+def forget_books(manifest, books):
+    """Drop the manifest entries of books written to out/ by something other
+    than rename, along with the index and store made from them, so the next
+    rename and store stages build them again.
+    """
+
+    for book in books:
+        manifest["books"].pop(book, None)
+    manifest.pop("index", None)
+    manifest.pop("store", None)
+
+
+def write_index(manifest):
+    """Write the verse reference index of the books in out/
+
+    The references recorded while converting each source file are shifted
+    by the size of the parts before them in the combined book, and the
+    chapters started by lines with only a book name are counted on from
+    the part before.
+    """
+
+    key = "|".join(manifest["books"].get(book, "") for book in book_files())
+    if (manifest.get("index") == key and
+            os.path.exists(lxxm_index.index_file)):
+        return
+    books = []
+    for book, parts in book_files().items():
+        refs = []
+        offset = 0
+        chapter = 0
+        for text in parts:
+            with open(refs_path(text)) as f:
+                for name, ref_chapter, label, start, end in json.load(f):
+                    if ref_chapter is None:
+                        chapter += 1
+                    else:
+                        chapter = ref_chapter
+                    refs.append([name, chapter, label, start + offset,
+                                 end + offset])
+            offset += os.path.getsize(build_path(text))
+        books.append(('out/' + book, refs))
+    print(lxxm_index.index_file)
+    lxxm_index.write_index(lxxm_index.build_index(books))
+    manifest["index"] = key
+
+
+def is_verse_line(line):
+    "Return whether a line of converted text is a verse line"
+
+    # Verse lines are kept in betacode, so only they start in ASCII letters
+    # or, as in "1Sam", digits
+    first = line[:1]
+    return first.isascii() and first.isalnum()
+
+
+def track_refs(lines, refs):
+    """Pass converted lines through, noting where each verse starts.
+
+    A [book, chapter, verse label, start, end] entry is appended to refs
+    for each verse line, with the byte offsets of the verse in the UTF-8
+    output. The chapter is None for a line with only a book name, since
+    the chapter it starts may carry on from the other half of a split
+    book; write_index counts it.
+    """
+
+    offset = 0
+    for line in lines:
+        if is_verse_line(line):
+            book, chapter, label = lxxm_index.parse_ref(line, None)
+            if refs:
+                refs[-1][4] = offset
+            refs.append([book, chapter, label, offset, None])
+        offset += len(line.encode("utf-8"))
+        yield line
+    if refs:
+        refs[-1][4] = offset
+
+
+def read_tokens(path, files):
+    """Yield (book, chapter, verse, form, morph, lemma) for each word of a
+    converted book, with the reference taken from its verse lines.
+
+    Books are named as in the verse reference index, with files passed to
+    lxxm_index.book_name.
+    """
+
+    book = path.split(".")[-2]
+    chapter = verse = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if is_verse_line(line):
+                book, chapter, label = lxxm_index.parse_ref(line, chapter)
+                book = lxxm_index.book_name(book, path, files)
+                verse = lxxm_index.verse_number(label)
+            elif line.strip():
+                fields = line.split()
+                yield (book, chapter, verse, fields[0], fields[1],
+                       " ".join(fields[2:]))
+
+
+def write_store(manifest):
+    """Write the binary token store of the whole LXXM next to out/
+
+    The store is only written again when a book changed since the last run.
+    """
+
+    books = list(book_files())
+    key = "|".join(manifest["books"].get(book, "") for book in books)
+    if manifest.get("store") == key and os.path.exists(store_file):
+        return
+    print(store_file)
+    files = {}
+    lxxm_store.write_store(store_file, (
+        token for book in books
+        for token in read_tokens('out/' + book, files)))
+    manifest["store"] = key
 
-def concatenate(text1, text2):
-    "Concatenate text2 to text1, then delete text2"
-
-    file2 = codecs.open('out/' + text2, encoding="utf-8")
-    file2_txt = file2.read()
-    file2.close()
-    file1 = open('out/' + text1, "a")
-    file1.write(file2_txt)
-    file1.close()
-    os.remove('out/' + text2)
-
-
-def rename():
-    "Combine and rename the books"
-
-    # Genesis
-    concatenate("01.Gen.1.txt", "02.Gen.2.txt")
-    os.rename("out/01.Gen.1.txt", "out/01.Gen.txt")
-    # Psalms
-    concatenate("28.Psalms1.txt", "29.Psalms2.txt",)
-    os.rename("out/28.Psalms1.txt", "out/28.Psalms.txt")
-    # Isaiah
-    concatenate("50.Isaiah1.txt", "51.Isaiah2.txt")
-    os.rename("out/50.Isaiah1.txt", "out/50.Isaiah.txt")
-    # Jeremiah
-    concatenate("52.Jer1.txt", "53.Jer2.txt")
-    os.rename("out/52.Jer1.txt", "out/52.Jer.txt")
-    # Ezekiel
-    concatenate("57.Ezek1.txt", "58.Ezek2.txt")
-    os.rename("out/57.Ezek1.txt", "out/57.Ezek.txt")
-
-    # Renumber
-    i = 0
-    books = os.listdir('out/')
-    books.sort()
-    for path in books:
-        i += 1
-        book = path.split(".", 1)[1]
-        os.rename('out/' + path, 'out/{:0>2}.{}'.format(i, book))
-
-
-def download_lxxm():
-    "Download the collection of lxxmorph files"
+
+class Fetcher(object):
+    """Download files from one HTTP server.
+
+    Each thread keeps its connections open between requests, and an
+    interrupted download is resumed from its partial file with a Range
+    request. Redirects are followed, to other servers as well.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        "Return this thread's connection to a server, opening it if needed"
+
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=60)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=60)
+            conns[(scheme, netloc)] = conn
+        return conn
+
+    def _close(self):
+        "Drop this thread's connections after an error"
+
+        for conn in getattr(self._local, "conns", {}).values():
+            conn.close()
+        self._local.conns = None
+
+    def _request(self, method, name, headers):
+        """Request name from the server and return the response, following
+        up to max_redirects redirects.
+        """
+
+        url = self.url + name
+        for hop in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            target = parts.path + ("?" + parts.query if parts.query else "")
+            conn = self._connection(parts.scheme, parts.netloc)
+            conn.request(method, target, headers=headers)
+            response = conn.getresponse()
+            if response.status not in redirect_codes:
+                return response
+            response.read()
+            location = response.getheader("Location")
+            if location is None:
+                raise IOError("HTTP {} without a Location for {}".format(
+                    response.status, name))
+            url = urllib.parse.urljoin(url, location)
+        raise IOError("Too many redirects for " + name)
+
+    def size(self, name):
+        """Return the size of name on the server from a HEAD request, or None
+        if the server does not say.
+        """
+
+        try:
+            response = self._request("HEAD", name, {})
+            response.read()
+        except (http.client.HTTPException, OSError):
+            self._close()
+            return None
+        length = response.getheader("Content-Length")
+        if response.status != 200 or length is None:
+            return None
+        return int(length)
+
+    def fetch(self, name, path, retries=2):
+        """Download name from the server to path.
+
+        The data goes to path + ".part", which is only renamed to path once
+        complete, so an interrupted download is never taken for a full file
+        and is resumed on the next try. Returns the number of bytes
+        received, the latency to the first response and the total time.
+        """
+
+        part_path = path + ".part"
+        received = 0
+        latency = None
+        start = time.perf_counter()
+        for attempt in range(retries + 1):
+            offset = 0
+            if os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+            headers = {}
+            if offset:
+                headers["Range"] = "bytes={}-".format(offset)
+            try:
+                response = self._request("GET", name, headers)
+                if latency is None:
+                    latency = time.perf_counter() - start
+                if response.status == 416 and offset:
+                    # The partial file already holds everything
+                    response.read()
+                    break
+                if response.status not in (200, 206):
+                    response.read()
+                    raise IOError("HTTP {} {} for {}".format(
+                        response.status, response.reason, name))
+                mode = "ab" if response.status == 206 else "wb"
+                with open(part_path, mode) as f:
+                    before = f.tell()
+                    try:
+                        shutil.copyfileobj(response, f, 1 << 16)
+                    finally:
+                        received += f.tell() - before
+                    length = response.getheader("Content-Length")
+                    if length is not None and f.tell() - before < int(length):
+                        # The server closed the connection early
+                        raise http.client.IncompleteRead(b"", int(length))
+                break
+            except (http.client.HTTPException, OSError):
+                self._close()
+                if attempt == retries:
+                    raise
+        os.replace(part_path, path)
+        return received, latency, time.perf_counter() - start
+
+
+def download_lxxm(manifest, url=base_url, connections=4):
+    """Download the collection of lxxmorph files
+
+    Files are fetched concurrently over the given number of connections.
+    The hash of each file is checked against the manifest, or recorded if
+    this is the first run to see the file. Files already present are kept
+    unless their hash does not match. A file present but not yet in the
+    manifest, such as one left by an older version of this script, is only
+    recorded once its size matches the server's, and downloaded again if it
+    does not. Returns the names that failed.
+    """
 
     print("Retrieving texts")
     print(readme)
-    if not os.path.exists('source/'):
-        os.mkdir('source')
+    os.makedirs('source', exist_ok=True)
+    needed = []
+    unknown = []
     for text in texts:
-        url = base_url + text
-        if not os.path.exists('source/' + os.path.basename(url)):
-            print(text)
-            urllib.request.urlretrieve(url, 'source/' + os.path.basename(url))
+        path = 'source/' + text
+        if not os.path.exists(path):
+            needed.append(text)
+        elif text not in manifest["sources"]:
+            unknown.append(text)
+        elif file_hash(path) != manifest["sources"][text]:
+            print("Checksum mismatch for {}, downloading again".format(text))
+            os.remove(path)
+            needed.append(text)
+
+    fetcher = Fetcher(url)
+    with concurrent.futures.ThreadPoolExecutor(connections) as pool:
+        sizes = list(pool.map(fetcher.size, unknown))
+    for text, size in zip(unknown, sizes):
+        path = 'source/' + text
+        if size is None:
+            print("Could not check the size of {}, not recording it".format(
+                text))
+        elif os.path.getsize(path) != size:
+            print("Size mismatch for {}, downloading again".format(text))
+            os.remove(path)
+            needed.append(text)
+        else:
+            manifest["sources"][text] = file_hash(path)
+
+    failed = []
+    total_bytes = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(connections) as pool:
+        futures = collections.OrderedDict(
+            (pool.submit(fetcher.fetch, text, 'source/' + text), text)
+            for text in needed)
+        for future in concurrent.futures.as_completed(futures):
+            text = futures[future]
+            try:
+                received, latency, elapsed = future.result()
+            except Exception as e:
+                print("Failed to download {}: {}".format(text, e))
+                failed.append(text)
+                continue
+            digest = file_hash('source/' + text)
+            expected = manifest["sources"].setdefault(text, digest)
+            if digest != expected:
+                print("Checksum mismatch for downloaded " + text)
+                os.remove('source/' + text)
+                failed.append(text)
+                continue
+            total_bytes += received
+            print("{}: {} bytes, first response {:.0f} ms, {:.2f}s".format(
+                text, received, latency * 1000, elapsed))
+    if needed:
+        elapsed = time.perf_counter() - start
+        print("Downloaded {} files, {} bytes in {:.2f}s ({:.0f} KB/s)".format(
+            len(needed) - len(failed), total_bytes, elapsed,
+            total_bytes / elapsed / 1000))
+    return [text for text in texts if text in failed]
+
+
+def parse_corrections(patch_path):
+    """Parse a git-style patch of the source files into a correction index.
+
+    Returns a dictionary mapping each source file the patch changes to its
+    own index, which maps the number of each original line that is
+    replaced to a tuple of the original line and its replacement lines.
+    """
+
+    corrections = {}
+    index = None
+    with open(patch_path) as f:
+        for line in f:
+            if line.startswith("diff --git "):
+                text = os.path.basename(line.split()[-1])
+                index = corrections.setdefault(text, {})
+            elif line.startswith("@@"):
+                number = int(line.split()[1][1:].split(",")[0])
+                removed = None
+                previous = None
+            elif index is None or line.startswith(("---", "+++", "\\")):
+                continue
+            elif line.startswith(" "):
+                number += 1
+                removed = None
+            elif line.startswith("-"):
+                index[number] = (line[1:], [])
+                if removed is None:
+                    removed = number
+                number += 1
+            elif line.startswith("+"):
+                if removed is None:
+                    # Insertion, keep the preceding line and add to it
+                    if previous is None:
+                        print("Unsupported insertion at line {} of {}".format(
+                            number, text))
+                        raise Exception
+                    removed = number - 1
+                    original = index.get(removed, (previous, [previous]))
+                    index[removed] = original
+                index[removed][1].append(line[1:])
+            if line.startswith(" "):
+                previous = line[1:]
+    return corrections
+
+
+def corrections_hash(corrections):
+    "Return a hash of the correction index of one source file"
+
+    items = sorted((corrections or {}).items())
+    return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()
+
+
+def correct_lines(lines, corrections):
+    """Yield the lines with the corrections for their file applied.
+
+    Each corrected line must still read as the patch expects, and every
+    correction must be used.
+    """
+
+    number = 0
+    for number, line in enumerate(lines, 1):
+        correction = corrections.get(number)
+        if correction is None:
+            yield line
+            continue
+        original, replacement = correction
+        if line != original:
+            print("Correction does not match line {}: {}".format(number, line))
+            raise Exception
+        for new_line in replacement:
+            yield new_line
+    if corrections and max(corrections) > number:
+        print("Corrections past the end of the file at line {}".format(
+            max(corrections)))
+        raise Exception
+
+
+def is_corrected(lines, corrections):
+    """Return whether the lines already read as the corrections make them.
+
+    Earlier versions of this script patched the files in source/ in place,
+    so those of an existing checkout may hold their corrections already.
+    """
+
+    expected = {}
+    shift = 0
+    for number, (original, replacement) in sorted(corrections.items()):
+        for i, new_line in enumerate(replacement):
+            expected[number + shift + i] = new_line
+        shift += len(replacement) - 1
+    if not expected:
+        return False
+    last = max(expected)
+    for number, line in enumerate(lines, 1):
+        if number in expected and line != expected[number]:
+            return False
+        if number == last:
+            return True
+    return False
+
+
+def source_corrections(patch_path):
+    """Return the correction index of the patch for the files in source/.
+
+    Files that already hold their corrections are left out, so they are
+    converted as they are.
+    """
+
+    corrections = parse_corrections(patch_path)
+    for text, index in list(corrections.items()):
+        if (os.path.exists('source/' + text) and
+                is_corrected(read_lines(text), index)):
+            print("{} is already corrected".format(text))
+            del corrections[text]
+    return corrections
 
 
 def to_unicode(betacode):
@@ -183,46 +741,167 @@ def to_unicode(betacode):
     return unicodedata.normalize("NFC", unicode_txt)
 
 
-def convert_file(path):
-    "Convert the contents of the file from betacode to unicode"
-
-    if not os.path.exists('out'):
-        os.mkdir('out')
-    out_path = "out/" + path.rsplit(".", 1)[0] + ".txt"
-    print(out_path)
-    out_text = ""
-    # Book, chapter, verse, and (all together) refrent not implemented yet
-    # book = path[0:2]
-    # chapter = ""
-    # verse = ""
-    # ref = ""
-    f = open('source/' + path)
-    lines = f.readlines()
-    f.close()
+class BetacodeCache(object):
+    """Bounded cache of betacode to unicode conversions.
+
+    The LXXM has far fewer distinct betacode strings than tokens, so each
+    string is converted once and then reused. The least recently used
+    entries are dropped once the cache holds more than size entries, and
+    a size of 0 disables caching. Entries can be saved to and loaded from
+    a JSON file to carry them between runs. With track_new the entries
+    converted are also kept for take_new, as worker processes do to pass
+    them back.
+    """
+
+    def __init__(self, size=65536, track_new=False):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.track_new = track_new
+        self._entries = collections.OrderedDict()
+        self._new = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def convert(self, betacode):
+        "Return the unicode for the given betacode, converting on a miss"
+
+        try:
+            unicode_txt = self._entries[betacode]
+        except KeyError:
+            self.misses += 1
+            unicode_txt = to_unicode(betacode)
+            if self.size > 0:
+                self._entries[betacode] = unicode_txt
+                if self.track_new:
+                    self._new.append((betacode, unicode_txt))
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(betacode)
+        return unicode_txt
+
+    def stats(self):
+        "Return a one-line summary of the cache counters"
+
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "{} hits, {} misses ({:.1f}% hit rate), {} entries".format(
+            self.hits, self.misses, rate, len(self._entries))
+
+    def take_new(self):
+        "Return the entries converted since the last call and forget them"
+
+        new, self._new = self._new, []
+        return new
+
+    def update(self, entries):
+        "Add (betacode, unicode) entries converted elsewhere"
+
+        for betacode, unicode_txt in entries:
+            self._entries[betacode] = unicode_txt
+            self._entries.move_to_end(betacode)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def load(self, path):
+        "Load previously saved entries from path, if it exists"
+
+        if not os.path.exists(path):
+            return
+        with codecs.open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+        self.update(entries)
+
+    def save(self, path):
+        "Save the current entries to path, least recently used first"
+
+        with codecs.open(path, "w", encoding="utf-8") as f:
+            json.dump(list(self._entries.items()), f, ensure_ascii=False)
+
+
+def read_lines(path):
+    "Yield the lines of the given source file one at a time"
+
+    with open('source/' + path) as f:
+        for line in f:
+            yield line
+
+
+def split_regex(line):
+    """Split a word line into its word, morph and root parts with word_pat.
+
+    Returns None if the line is not a word line.
+    """
+
+    word_line = word_pat.search(line)
+    if not word_line:
+        return None
+    return (word_line.group('word'), word_line.group('morph'),
+            word_line.group('root').split())
+
+
+def split_columns(line):
+    """Split a word line on the fixed LXXM columns.
+
+    The word fills the first 25 columns, the morph the next 10 and the root
+    follows after whitespace. Lines that do not fit that layout are handed
+    to split_regex, so the result is always the same as split_regex's.
+    """
+
+    if len(line) < 36 or line[25].isspace() or not line[35].isspace():
+        return split_regex(line)
+    word = line[:25].rstrip()
+    morph = line[25:35]
+    root = line[35:]
+    # Stripping the allowed characters leaves nothing if the column is valid
+    if word.strip(beta_chars) or morph.strip(morph_chars) or \
+            root.strip(root_chars):
+        return split_regex(line)
+    return word, morph, root.split()
+
+
+# Word line splitters selectable with --tokenizer
+tokenizers = {"columns": split_columns, "regex": split_regex}
+
+
+def convert_tokens(lines, convert=to_unicode, split=split_columns):
+    """Yield the unicode output line for each line of LXXM source, with the
+    converted (word, morph, roots) of word lines or None for other lines.
+
+    Betacode is converted with the convert function, which may be the
+    convert method of a BetacodeCache, and word lines are split into
+    their parts with split.
+    """
+
+    # Verse lines pass through unchanged, for track_refs to follow the
+    # book, chapter and verse
     for line in lines:
         verse_line = None
         # All word lines are longer than 25 characters, the width of 1st column
         if len(line) < 25:
             verse_line = verse_pat.match(line)
-        word_line = word_pat.search(line)
+        word_line = None
+        if not verse_line:
+            word_line = split(line)
 
         if verse_line:
-            out_text += line
+            yield line, None
 
         elif word_line:
-            beta_word = word_line.group('word')
-            morph = word_line.group('morph')
+            beta_word, morph, beta_root = word_line
             # Ensure that morph tags are not missed by the parser
             if (not morph) or (morph == "          "):
                 print("Missed morph")
                 raise Exception
-            beta_root = word_line.group('root').split()
 
             # Replace whitespace in morph with -
             morph = morph.replace(" ", "-")
 
-            word = to_unicode(beta_word)
-            output = "{} {}".format(word, morph)
+            word = convert(beta_word)
+            output = [word, morph]
             # Add each part of the root
             for part in beta_root:
                 # Correct for '+' in root in some instances
@@ -234,47 +913,608 @@ def convert_file(path):
                     and ("+" not in beta_word)):
                     crasis = True
                     part = part.replace("+", " ")
-                rt = to_unicode(part)
+                rt = convert(part)
                 if crasis:
                     rt = rt.replace(" ", "+")
-                output += " " + rt
-            out_text += output + "\n"
+                output.append(rt)
+            yield " ".join(output) + "\n", (word, morph, output[2:])
 
         elif line == "\n":
-            out_text += line
+            yield line, None
 
         elif line != "\n":
             print("Missed line: " + line)
             raise Exception
 
-    o = open(out_path, "w")
-    o.write(out_text)
-    o.close()
+
+def convert_lines(lines, convert=to_unicode, split=split_columns):
+    "Yield the unicode output line for each line of LXXM source"
+
+    for line, word in convert_tokens(lines, convert, split):
+        yield line
+
+
+def write_lines(out_path, lines):
+    """Write the lines to out_path through a buffered writer.
+
+    The lines go to a temporary file that replaces out_path only once
+    every line has been written, so a failed conversion leaves no partial
+    output behind.
+    """
+
+    tmp_path = out_path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8",
+                  buffering=write_buffer) as o:
+            o.writelines(lines)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, out_path)
+
+
+def convert_file(path, cache=None, tokenizer="columns", corrections=None):
+    """Convert the contents of the file from betacode to unicode
+
+    The file is streamed line by line from source/ to build/, so memory use
+    does not depend on the size of the book. The file's corrections from
+    parse_corrections are applied on the way, leaving the source file
+    untouched. Conversions go through cache when one is given, and word
+    lines are split with the named tokenizer. The byte range of each verse
+    is saved next to the output for the verse reference index.
+    """
+
+    convert = cache.convert if cache is not None else to_unicode
+
+    os.makedirs('build', exist_ok=True)
+    out_path = build_path(path)
+    lines = correct_lines(read_lines(path), corrections or {})
+    refs = []
+    write_lines(out_path, track_refs(
+        convert_lines(lines, convert, tokenizers[tokenizer]), refs))
+    with open(refs_path(path), "w") as f:
+        json.dump(refs, f, separators=(",", ":"))
+
+
+# Per-process cache, tokenizer and corrections of the convert_texts workers
+_worker_cache = None
+_worker_tokenizer = None
+_worker_corrections = None
+
+
+def _init_worker(cache_size, cache_file, tokenizer, corrections):
+    "Set up the conversion cache, tokenizer and corrections of a worker"
+
+    global _worker_cache, _worker_tokenizer, _worker_corrections
+    _worker_tokenizer = tokenizer
+    _worker_corrections = corrections
+    _worker_cache = BetacodeCache(cache_size, track_new=True)
+    if cache_file:
+        _worker_cache.load(cache_file)
+
+
+def _worker_call(name, func, *args):
+    """Call func with args in a worker process.
+
+    Returns the name, the formatted traceback on failure (or None), the
+    cache hits and misses of the call, and the new cache entries.
+    """
+
+    hits, misses = _worker_cache.hits, _worker_cache.misses
+    try:
+        func(*args)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return (name, error, _worker_cache.hits - hits,
+            _worker_cache.misses - misses, _worker_cache.take_new())
+
+
+def _convert_worker(text):
+    "Convert one file in a worker process"
+
+    return _worker_call(text, convert_file, text, _worker_cache,
+                        _worker_tokenizer, _worker_corrections.get(text))
+
+
+def _pool_map(worker, items, cache, jobs, cache_file, tokenizer,
+              corrections):
+    """Run worker on each item in a pool of processes.
+
+    Yields the name and traceback (or None) of each item as it finishes,
+    so the caller can report progress while the others are still running.
+    The workers' cache counters and new entries are folded back into cache.
+    """
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(cache.size, cache_file, tokenizer,
+                      corrections)) as pool:
+        futures = [pool.submit(worker, item) for item in items]
+        for future in concurrent.futures.as_completed(futures):
+            name, error, hits, misses, new = future.result()
+            cache.hits += hits
+            cache.misses += misses
+            cache.update(new)
+            yield name, error
+
+
+def convert_texts(texts, cache, jobs=1, cache_file=None,
+                  tokenizer="columns", corrections=None):
+    """Convert each of the given files, returning the names that failed.
+
+    With more than one job the files are spread over a pool of worker
+    processes, largest first so that the biggest books start right away.
+    Each file is still written by a single convert_file call, so the output
+    is the same as a serial run.
+    """
+
+    corrections = corrections or {}
+    failed = []
+    if jobs == 1:
+        for text in texts:
+            print(build_path(text))
+            try:
+                convert_file(text, cache, tokenizer, corrections.get(text))
+            except Exception:
+                print("Failed to convert {}:\n{}".format(
+                    text, traceback.format_exc()))
+                failed.append(text)
+        return failed
+
+    os.makedirs('build', exist_ok=True)
+    by_size = sorted(texts, key=lambda text: os.path.getsize('source/' + text),
+                     reverse=True)
+    for text, error in _pool_map(_convert_worker, by_size, cache, jobs,
+                                 cache_file, tokenizer, corrections):
+        print(build_path(text))
+        if error:
+            print("Failed to convert {}:\n{}".format(text, error))
+            failed.append(text)
+    return [text for text in texts if text in failed]
+
+
+class Sink(object):
+    """Base class of the outputs fed by the pipeline stage.
+
+    A sink is made for each book and told about every line of it in turn.
+    Its file is written to a temporary name that replaces the final one
+    when the book is closed.
+    """
+
+    directory = None
+
+    def __init__(self, book):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, self.file_name(book))
+        self.out = open(self.path + ".tmp", "w", encoding="utf-8",
+                        buffering=write_buffer)
+
+    def file_name(self, book):
+        "Return the name of the sink's file for the given book"
+
+        return book
+
+    def verse(self, line, ref):
+        "Take a verse line and its (book, chapter, verse label)"
+
+    def word(self, line, word, morph, roots):
+        "Take a word line and its converted parts"
+
+    def blank(self, line):
+        "Take a blank line, which ends a verse"
+
+    def close(self):
+        "Finish the book and move the file into place"
+
+        self.out.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def abort(self):
+        "Give up on the book, removing the temporary file"
+
+        self.out.close()
+        os.remove(self.path + ".tmp")
+
+
+class UnicodeSink(Sink):
+    "The unicode text, as made by the convert and rename stages"
+
+    directory = 'out'
+
+    def verse(self, line, ref):
+        self.out.write(line)
+
+    def word(self, line, word, morph, roots):
+        self.out.write(line)
+
+    def blank(self, line):
+        self.out.write(line)
+
+
+class LayoutSink(Sink):
+    "One row per word laid out like MorphGNT, as by lxxm-layout.py"
+
+    directory = 'new'
+
+    def __init__(self, book):
+        Sink.__init__(self, book)
+        self.book_num = book.split(".")[0]
+        self.ref = ""
+
+    def verse(self, line, ref):
+        book, chapter, label = ref
+        digits = len(label) - len(label.lstrip("0123456789"))
+        self.ref = "%s%03d%03d%s" % (self.book_num, chapter,
+                                     int(label[:digits]), label[digits:])
+
+    def word(self, line, word, morph, roots):
+        self.out.write("%s %s %s %s\n" % (self.ref, morph, word, roots[0]))
+
+
+class PlainSink(Sink):
+    "One verse per line, as by lxxm-plain.py"
+
+    directory = 'plain'
+
+    def __init__(self, book):
+        Sink.__init__(self, book)
+        self.words = []
+
+    def word(self, line, word, morph, roots):
+        self.words.append(word)
+
+    def blank(self, line):
+        self.out.write(" ".join(self.words) + "\n")
+        self.words = []
+
+
+class CorpusSink(Sink):
+    "Slash-tagged NLTK corpus text, as by lxxm-corpus.py"
+
+    directory = 'lxxm-corpus'
+
+    def __init__(self, book):
+        # Imported here so the other stages work with catss/ on its own
+        if morphtags_dir not in sys.path:
+            sys.path.insert(0, morphtags_dir)
+        from morphtags import lxxm_tags
+        self.tags = lxxm_tags
+        Sink.__init__(self, book)
+        self.sep = ""
+
+    def file_name(self, book):
+        return book.rsplit(".", 1)[0]
+
+    def token(self, token):
+        self.out.write(self.sep + token)
+        self.sep = " "
+
+    def word(self, line, word, morph, roots):
+        self.token(word + '/' + self.tags[morph])
+
+    def blank(self, line):
+        # Empty lines signify verse breaks, treat as sentence breaks
+        self.token("\n")
+
+
+# Outputs the pipeline stage can produce, by name
+sinks = collections.OrderedDict([("unicode", UnicodeSink),
+                                 ("layout", LayoutSink),
+                                 ("plain", PlainSink),
+                                 ("corpus", CorpusSink)])
+
+
+def pipeline_book(book, parts, sink_names, cache=None, tokenizer="columns",
+                  corrections=None):
+    """Parse the source files of one book once, feeding each line to the
+    named sinks.
+    """
+
+    convert = cache.convert if cache is not None else to_unicode
+    corrections = corrections or {}
+    outputs = []
+    try:
+        for name in sink_names:
+            outputs.append(sinks[name](book))
+        chapter = 0
+        for text in parts:
+            lines = correct_lines(read_lines(text), corrections.get(text, {}))
+            for line, word in convert_tokens(lines, convert,
+                                             tokenizers[tokenizer]):
+                if word:
+                    for output in outputs:
+                        output.word(line, *word)
+                elif line == "\n":
+                    for output in outputs:
+                        output.blank(line)
+                else:
+                    ref = lxxm_index.parse_ref(line, chapter)
+                    chapter = ref[1]
+                    for output in outputs:
+                        output.verse(line, ref)
+    except BaseException:
+        for output in outputs:
+            output.abort()
+        raise
+    for output in outputs:
+        output.close()
+
+
+def _pipeline_worker(job):
+    "Run the pipeline on one book in a worker process"
+
+    book, parts, sink_names = job
+    return _worker_call(book, pipeline_book, book, parts, sink_names,
+                        _worker_cache, _worker_tokenizer, _worker_corrections)
+
+
+def run_pipeline(sink_names, cache, jobs=1, cache_file=None,
+                 tokenizer="columns", corrections=None):
+    """Run the pipeline on every book, returning the books that failed.
+
+    Like convert_texts, more than one job spreads the books over a pool of
+    worker processes, largest first.
+    """
+
+    books = book_files()
+    failed = []
+    if jobs == 1:
+        for book, parts in books.items():
+            print(book)
+            try:
+                pipeline_book(book, parts, sink_names, cache, tokenizer,
+                              corrections)
+            except Exception:
+                print("Failed to process {}:\n{}".format(
+                    book, traceback.format_exc()))
+                failed.append(book)
+        return failed
+
+    by_size = sorted(books, reverse=True, key=lambda book: sum(
+        os.path.getsize('source/' + text) for text in books[book]))
+    work = [(book, books[book], sink_names) for book in by_size]
+    for book, error in _pool_map(_pipeline_worker, work, cache, jobs,
+                                 cache_file, tokenizer, corrections):
+        print(book)
+        if error:
+            print("Failed to process {}:\n{}".format(book, error))
+            failed.append(book)
+    return [book for book in books if book in failed]
+
+
+def conversion_inputs(text, corrections, version):
+    "Return the hashes of everything the conversion of a source file uses"
+
+    return "|".join([file_hash('source/' + text),
+                     corrections_hash(corrections.get(text)), version])
+
+
+def stale_texts(manifest, corrections):
+    """Return the source files whose conversion is missing or out of date.
+
+    A conversion is out of date when the source file, its corrections or
+    this script changed since it was made, or when its output was changed
+    or removed.
+    """
+
+    version = code_version()
+    stale = []
+    for text in texts:
+        inputs = conversion_inputs(text, corrections, version)
+        converted = manifest["converted"].get(text)
+        if (converted and converted["inputs"] == inputs and
+                os.path.exists(build_path(text)) and
+                os.path.exists(refs_path(text)) and
+                file_hash(build_path(text)) == converted["sha256"]):
+            continue
+        stale.append(text)
+    return stale
+
+
+def record_conversions(converted_texts, manifest, corrections):
+    "Record the inputs and output hashes of freshly converted files"
+
+    version = code_version()
+    for text in converted_texts:
+        manifest["converted"][text] = {
+            "inputs": conversion_inputs(text, corrections, version),
+            "sha256": file_hash(build_path(text))}
+
+
+def bench_convert(paths, cache, corrections):
+    """Print the throughput and peak memory of converting each file.
+
+    The streaming convert_file pipeline is compared with the earlier
+    approach of reading the whole file and growing one output string. The
+    cache is warmed first so that betacode decoding does not dominate.
+    """
+
+    def accumulate(path, out_path):
+        f = open('source/' + path)
+        lines = f.readlines()
+        f.close()
+        out_text = ""
+        lines = correct_lines(lines, corrections.get(path, {}))
+        for line in convert_lines(lines, cache.convert):
+            out_text += line
+        o = open(out_path, "w", encoding="utf-8")
+        o.write(out_text)
+        o.close()
+
+    def stream(path, out_path):
+        lines = correct_lines(read_lines(path), corrections.get(path, {}))
+        write_lines(out_path, convert_lines(lines, cache.convert))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, "bench.txt")
+        for path in paths:
+            size = os.path.getsize('source/' + path)
+            stream(path, out_path)
+            for name, run in (("accumulate", accumulate), ("stream", stream)):
+                start = time.perf_counter()
+                run(path, out_path)
+                elapsed = time.perf_counter() - start
+                tracemalloc.start()
+                run(path, out_path)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print("{} {:>10}: {:.3f}s, {:.1f} MB/s, peak {} KiB".format(
+                    path, name, elapsed, size / elapsed / 1e6, peak // 1024))
+
+
+def bench_tokenizers(paths):
+    """Print the time taken to split every line of each file, first with
+    word_pat alone and then on columns with word_pat as the fallback.
+
+    Raises an exception if the two ever split a line differently.
+    """
+
+    totals = {"regex": 0.0, "columns": 0.0}
+    for path in paths:
+        f = open('source/' + path)
+        lines = [line for line in f if len(line) >= 25]
+        f.close()
+        results = {}
+        for name in ("regex", "columns"):
+            split = tokenizers[name]
+            start = time.perf_counter()
+            results[name] = [split(line) for line in lines]
+            elapsed = time.perf_counter() - start
+            totals[name] += elapsed
+            print("{} {:>7}: {:.3f}s, {:.0f} lines/s".format(
+                path, name, elapsed, len(lines) / elapsed))
+        if results["regex"] != results["columns"]:
+            print("Tokenizers disagree on " + path)
+            raise Exception
+    print("Total: regex {:.3f}s, columns {:.3f}s ({:.1f}x)".format(
+        totals["regex"], totals["columns"],
+        totals["regex"] / totals["columns"]))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Convert the CATSS LXXM text to unicode")
     subs = parser.add_subparsers(dest='command')
+    # Options shared by the stages that convert
+    conv_opts = argparse.ArgumentParser(add_help=False)
+    conv_opts.add_argument("--cache-size", type=int, default=65536,
+                           help="Maximum number of cached betacode "
+                           "conversions (0 disables the cache)")
+    conv_opts.add_argument("--cache-file",
+                           help="Load the conversion cache from this file "
+                           "and save it back after converting")
+    conv_opts.add_argument("-j", "--jobs", type=int, default=1,
+                           help="Number of files to convert in parallel "
+                           "(0 uses every CPU)")
+    conv_opts.add_argument("--tokenizer", choices=sorted(tokenizers),
+                           default="columns",
+                           help="Split word lines on their fixed columns, "
+                           "falling back to a regex for malformed lines, "
+                           "or always with the regex")
+    # Options shared by the stages that download
+    dl_opts = argparse.ArgumentParser(add_help=False)
+    dl_opts.add_argument("--base-url", default=base_url,
+                         help="Where to download the lxxmorph files from")
+    dl_opts.add_argument("--connections", type=int, default=4,
+                         help="Number of files to download at once")
     # Download
-    parser_dl = subs.add_parser("download", help="Download the files")
-    # Patch
-    parser_diff = subs.add_parser("patch", help="Apply corrections")
+    parser_dl = subs.add_parser("download", parents=[dl_opts],
+                                help="Download the files")
     # Convert
-    parser_conv = subs.add_parser("convert",
+    parser_conv = subs.add_parser("convert", parents=[conv_opts],
                                   help="Convert from betacode to unicode")
     # Rename
-    parser_ren = subs.add_parser("rename", help="Rename files")
+    parser_ren = subs.add_parser("rename",
+                                 help="Combine and number the books in out/")
+    # Pipeline
+    parser_pipe = subs.add_parser("pipeline", parents=[conv_opts],
+                                  help="Make the chosen outputs in one pass")
+    parser_pipe.add_argument("--sinks", default=",".join(sinks),
+                             help="Comma-separated outputs to make, from: "
+                             + ", ".join(sinks) + " (default: all)")
+    # Store
+    parser_store = subs.add_parser("store",
+                                   help="Write the binary token store")
+    # Benchmark
+    parser_bench = subs.add_parser("bench",
+                                   help="Time the conversion of some files")
+    parser_bench.add_argument("--cache-size", type=int, default=65536,
+                              help="Maximum number of cached betacode "
+                              "conversions")
+    parser_bench.add_argument("--tokenizers", action="store_true",
+                              help="Compare the line tokenizers instead, "
+                              "on every source file by default")
+    parser_bench.add_argument("files", nargs="*",
+                              help="Source files to time (default: Genesis "
+                              "and Psalms)")
     # All
-    parser_all = subs.add_parser("all", help="Complete all actions")
+    parser_all = subs.add_parser("all", parents=[dl_opts, conv_opts],
+                                 help="Complete all actions")
     args = parser.parse_args()
 
+    manifest = load_manifest()
     if args.command == "download" or args.command == "all":
-        download_lxxm()
-    # Apply corrections so unicode conversion will work
-    if args.command == "patch" or args.command == "all":
-        subprocess.call("patch -p1 < lxxm-corrections.patch", shell=True)
+        failed = download_lxxm(manifest, args.base_url, args.connections)
+        save_manifest(manifest)
+        if failed:
+            print("Failed to download: " + ", ".join(failed))
+            sys.exit(1)
     if args.command == "convert" or args.command == "all":
-        for text in texts:
-            convert_file(text)
+        # Corrections are applied while converting so unicode conversion
+        # will work
+        corrections = source_corrections(patch_file)
+        stale = stale_texts(manifest, corrections)
+        print("{} of {} files to convert".format(len(stale), len(texts)))
+        cache = BetacodeCache(args.cache_size)
+        if args.cache_file:
+            cache.load(args.cache_file)
+        jobs = args.jobs or os.cpu_count()
+        failed = convert_texts(stale, cache, jobs, args.cache_file,
+                               args.tokenizer, corrections)
+        record_conversions([text for text in stale if text not in failed],
+                           manifest, corrections)
+        save_manifest(manifest)
+        print("Betacode cache: " + cache.stats())
+        if args.cache_file:
+            cache.save(args.cache_file)
+        if failed:
+            print("Failed to convert: " + ", ".join(failed))
+            sys.exit(1)
     if args.command == "rename" or args.command == "all":
-        rename()
+        missing = rename(manifest)
+        save_manifest(manifest)
+        if missing:
+            print("Not converted yet, run the convert stage first: "
+                  + ", ".join(missing))
+            sys.exit(1)
+    if args.command == "pipeline":
+        sink_names = args.sinks.split(",")
+        for name in sink_names:
+            if name not in sinks:
+                parser.error("unknown sink: " + name)
+        if "unicode" in sink_names:
+            # out/ no longer matches what rename recorded from build/
+            forget_books(manifest, book_files())
+            save_manifest(manifest)
+        cache = BetacodeCache(args.cache_size)
+        if args.cache_file:
+            cache.load(args.cache_file)
+        failed = run_pipeline(sink_names, cache, args.jobs or os.cpu_count(),
+                              args.cache_file, args.tokenizer,
+                              source_corrections(patch_file))
+        print("Betacode cache: " + cache.stats())
+        if args.cache_file:
+            cache.save(args.cache_file)
+        if failed:
+            print("Failed to process: " + ", ".join(failed))
+            sys.exit(1)
+    if args.command == "store" or args.command == "all":
+        write_store(manifest)
+        save_manifest(manifest)
+    if args.command == "bench" and args.tokenizers:
+        bench_tokenizers(args.files or texts)
+    elif args.command == "bench":
+        bench_convert(args.files or bench_texts,
+                      BetacodeCache(args.cache_size),
+                      source_corrections(patch_file))
@@ -17,91 +17,177 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import codecs
-import re
+import argparse
+import concurrent.futures
 import os
-import unicodedata
+import re
+import sys
+import traceback
 
+from lxxm_index import nfc, parse_ref
+
+# Verse lines are in ASCII, so \w must not match the Greek of word lines
 ref_pat_str = r'^(?P<book>[\w/]+) ?(?P<chapter>\d{1,3})?:?(?P<verse>\d{1,3})?'
-ref_pat = re.compile(ref_pat_str)
+ref_pat = re.compile(ref_pat_str, re.ASCII)
 verse_pat = re.compile(r'^(?P<verse>\d{1,3})?(?P<append>.*)')
 
 
-def format_verse(text):
-    "Accepts a raw verse string and return a properly-formatted verse string."
+def split_verse(text):
+    "Accepts a raw verse string and returns its number and any appended part."
 
     verse_match = verse_pat.match(text)
     verse = int(verse_match.group("verse"))
     append = ""
     if verse_match.group("append"):
         append = verse_match.group("append")
-    return "%03d%s" % (verse, append)
+    return verse, append
+
 
+def format_verse(text):
+    "Accepts a raw verse string and return a properly-formatted verse string."
 
-def convert_text(book_num, text):
-    """Accepts a sequential book number and an array of lxxmorph-unicode
-    lines from a single book and returns an array of converted lines,
-    or False on failure.
+    return "%03d%s" % split_verse(text)
+
+
+def convert_text(book_num, text, refs=None):
+    """Accepts a sequential book number and an iterable of lxxmorph-unicode
+    lines from a single book and yields the converted rows one at a time.
+
+    If refs is a list, the (chapter, verse, append, first row) of each
+    verse line is added to it, for pack_refs.
     """
 
-    out_lines = []
     verse = 0
     chapter = 0
     book = book_num
     verse_str = ""
+    rows = 0
     for line in text:
         verse_line = ref_pat.match(line)
         if verse_line:
-            items = line.split()
-            if len(items) > 1:
-                if ":" not in items[1]:
-                    chapter = 1
-                    verse = format_verse(items[1])
-                else:
-                    ref = items[1].split(":")
-                    # Handle Sirach
-                    if ref[0] == "Prolog":
-                        chapter = 0
-                    else:
-                        chapter = int(ref[0])
-                    verse = format_verse(ref[1])
-            else:
-                chapter += 1
-                verse = format_verse("0")
-            verse_str = "%s%03d%s" % (book, int(chapter), verse)
+            name, chapter, label = parse_ref(line, chapter)
+            verse, append = split_verse(label)
+            verse_str = "%s%03d%03d%s" % (book, chapter, verse, append)
+            if refs is not None:
+                refs.append((chapter, verse, append, rows))
         elif len(line.strip()) == 0:
             pass
         else:
             elements = line.strip().split()
-            out_lines.append("%s %s %s %s" % (verse_str, elements[1],
-                                              elements[0], elements[2]))
-    return out_lines
+            rows += 1
+            yield "%s %s %s %s" % (verse_str, elements[1], nfc(elements[0]),
+                                   nfc(elements[2]))
+
+
+def pack_refs(book_num, refs, rows):
+    """Returns the packed reference and appended part of each of rows rows,
+    given the verses collected by convert_text, as NumPy arrays.
+
+    Each reference is book * 1000000 + chapter * 1000 + verse, as an int32.
+    The appended parts ("a", "b", ...) are a table of strings, starting with
+    the empty string, and a uint8 index into it for each row.
+    """
+
+    import numpy
+
+    chapters, verses, appends, starts = zip(*refs)
+    packed = (int(book_num) * 1000000 + numpy.array(chapters) * 1000
+              + numpy.array(verses)).astype(numpy.int32)
+    table, ids = numpy.unique(numpy.array(("",) + appends),
+                              return_inverse=True)
+    if len(table) > 256:
+        raise ValueError("Too many distinct verse parts: %d" % len(table))
+    # Rows per verse, for spreading each verse over its rows
+    counts = numpy.diff(numpy.append(starts, rows))
+    return (numpy.repeat(packed, counts),
+            numpy.repeat(ids[1:].astype(numpy.uint8), counts), table)
+
+
+def write_refs(out_path, book_num, refs, rows):
+    """Writes the packed references of a book next to its layout, as
+    out_path + ".refs.npy", ".append.npy" and ".appends.npy".
+    """
+
+    import numpy
+
+    columns = zip(("refs", "append", "appends"),
+                  pack_refs(book_num, refs, rows))
+    for name, column in columns:
+        with open("%s.%s.npy.tmp" % (out_path, name), "wb") as f:
+            numpy.save(f, column)
+        os.replace("%s.%s.npy.tmp" % (out_path, name),
+                   "%s.%s.npy" % (out_path, name))
 
 
 def get_text(path):
-    "Returns an array of UTF-8 encoded lines from the given file."
+    "Yields the lines of the given file in out/ one at a time."
+
+    with open('out/' + path, encoding="utf-8") as f:
+        for line in f:
+            yield line
+
+
+def layout_file(path, npy=False):
+    """Lay out the given book from out/ into new/, with its packed references
+    as well if npy is true.
+    """
+
+    elems = path.split(".")
+    out_path = "new/%s" % path
+    print(out_path)
+    refs = [] if npy else None
+    rows = convert_text(elems[0], get_text(path), refs)
+    count = 0
+    with open(out_path + ".tmp", "w", encoding="utf-8",
+              buffering=1 << 16) as o:
+        for row in rows:
+            o.write(row + "\n")
+            count += 1
+    os.replace(out_path + ".tmp", out_path)
+    if npy:
+        write_refs(out_path, elems[0], refs, count)
+
+
+def _layout_worker(path, npy=False):
+    "Lay out one book in a worker process, returning any traceback"
 
     try:
-        f = codecs.open('out/' + path, encoding="utf-8")
-        text = f.readlines()
-        f.close()
-        return text
-    except:
-        return False
+        layout_file(path, npy)
+    except Exception:
+        return traceback.format_exc()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Lay out the unicode LXXM in out/ like MorphGNT in new/")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of books to lay out in parallel "
+                        "(0 uses every CPU)")
+    parser.add_argument("--npy", action="store_true",
+                        help="Also write the packed verse reference of each "
+                        "row as NumPy arrays (requires numpy)")
+    args = parser.parse_args()
+    if args.npy:
+        try:
+            import numpy
+        except ImportError:
+            parser.error("--npy requires numpy")
+
+    os.makedirs('new', exist_ok=True)
     paths = os.listdir('out/')
     paths.sort()
-    for path in paths:
-        elems = path.split(".")
-        lines = get_text(path)
-        final = convert_text(elems[0], lines)
-        out_path = "new/%s" % path
-        out_text = ""
-        for final_line in final:
-            out_text += "%s\n" % final_line
-        out_text = unicodedata.normalize("NFC", out_text)
-        o = open(out_path, "w")
-        o.write(out_text.encode("utf-8"))
-        o.close()
+    jobs = args.jobs or os.cpu_count()
+    npy = [args.npy] * len(paths)
+    if jobs == 1:
+        errors = map(_layout_worker, paths, npy)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            errors = list(pool.map(_layout_worker, paths, npy))
+    failed = []
+    for path, error in zip(paths, errors):
+        if error:
+            print("Failed to lay out {}:\n{}".format(path, error))
+            failed.append(path)
+    if failed:
+        print("Failed to lay out: " + ", ".join(failed))
+        sys.exit(1)
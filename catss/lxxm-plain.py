@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 #
 # lxxm-plain.py
 # Outputs the Unicode LXXM text, one verse per-line.
@@ -16,46 +16,107 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
 import argparse
-import codecs
+import concurrent.futures
+import json
 import os
-import unicodedata
+import sys
+import traceback
+
+from lxxm_index import nfc, parse_ref
 
-def convert_file_to_plain(path):
-    "Output the contents of the given LXXM file to plain text"
 
-    print path
-    if not os.path.exists('plain'):
-        os.mkdir('plain')
-    out_text = ""
-    out_path = "plain/" + path
-    f = codecs.open('out/' + path,encoding="utf-8")
-    lines = f.readlines()
-    f.close()
+def plain_verses(lines):
+    """Yield the (book, chapter, verse) and text of each verse of the given
+    LXXM lines as soon as the blank line ending it is read.
+    """
+
+    ref = (None, 0, "0")
     verse = []
     for line in lines:
-        
+
         # All word lines contain "-"
         if "-" in line:
             word = line.split()[0]
             verse.append(word)
-    
+
         # Add blanklines
         elif line == "\n":
-            line_text = " ".join(verse)
-            line_text += "\n"
-            out_text += line_text
+            yield ref, nfc(" ".join(verse))
             verse = []
 
-    out_text = unicodedata.normalize("NFC", out_text)
-    o = open(out_path,"w")
-    o.write(out_text.encode("utf-8"))
-    o.close()
+        elif line.strip():
+            ref = parse_ref(line, ref[1])
+
+
+def format_plain(ref, text):
+    "Return a verse as a line of plain text"
+
+    return text + "\n"
+
+
+def format_json(ref, text):
+    "Return a verse and its reference as a line of JSON"
+
+    book, chapter, verse = ref
+    return json.dumps({"book": book, "chapter": chapter, "verse": verse,
+                       "text": text}, ensure_ascii=False) + "\n"
+
+
+# Output formats, by name, with the extension of their files
+formats = {"plain": (format_plain, ""), "jsonl": (format_json, ".jsonl")}
+
+
+def convert_file_to_plain(path, out_format="plain"):
+    "Output the contents of the given LXXM file to plain text"
+
+    print(path)
+    format_verse, extension = formats[out_format]
+    out_path = "plain/" + path + extension
+    with open('out/' + path, encoding="utf-8") as f, \
+            open(out_path + ".tmp", "w", encoding="utf-8",
+                 buffering=1 << 16) as o:
+        for ref, text in plain_verses(f):
+            o.write(format_verse(ref, text))
+    os.replace(out_path + ".tmp", out_path)
+
+
+def _plain_worker(path, out_format="plain"):
+    "Convert one book in a worker process, returning any traceback"
+
+    try:
+        convert_file_to_plain(path, out_format)
+    except Exception:
+        return traceback.format_exc()
+
 
 if __name__ == '__main__':
-    
+    parser = argparse.ArgumentParser(
+        description="Output the unicode LXXM in out/ one verse per line in "
+        "plain/")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of books to convert in parallel "
+                        "(0 uses every CPU)")
+    parser.add_argument("--format", choices=sorted(formats), default="plain",
+                        help="plain text, or one JSON object per verse with "
+                        "its reference (default: plain)")
+    args = parser.parse_args()
+
+    os.makedirs('plain', exist_ok=True)
     paths = os.listdir('out/')
     paths.sort()
-    for path in paths:
-        convert_file_to_plain(path)
+    jobs = args.jobs or os.cpu_count()
+    out_formats = [args.format] * len(paths)
+    if jobs == 1:
+        errors = map(_plain_worker, paths, out_formats)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            errors = list(pool.map(_plain_worker, paths, out_formats))
+    failed = []
+    for path, error in zip(paths, errors):
+        if error:
+            print("Failed to convert {}:\n{}".format(path, error))
+            failed.append(path)
+    if failed:
+        print("Failed to convert: " + ", ".join(failed))
+        sys.exit(1)
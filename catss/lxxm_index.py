@@ -0,0 +1,198 @@
+#
+# lxxm_index.py
+# Verse reference index and passage lookup for the unicode LXXM
+# (c) 2026 Nathan D. Smith <nathan@smithfam.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import unicodedata
+
+# The index maps each book, as named in the verse lines of the text, to its
+# file in out/ and the byte range of every verse in that file:
+#
+#   {"Gen": {"file": "out/01.Gen.txt",
+#            "chapters": {"1": {"1": [0, 512], "2": [512, 1024], ...}}}}
+#
+# A verse's range starts at its verse line and runs to the next one, and
+# lettered verses such as "35a" keep their own entries.
+
+index_file = "lxxm-index.json"
+
+
+def book_name(book, path, files):
+    """Return the name a book of the verse lines of the file at path is
+    known by in the index and the token store.
+
+    files maps each book name to the first file it was found in, and is
+    updated. A book name found in more than one file is named after its
+    later files instead, such as "JoshA" for out/08.JoshA.txt.
+    """
+
+    if files.setdefault(book, path) != path:
+        return os.path.basename(path).split(".")[1]
+    return book
+
+
+def build_index(books):
+    """Return the index of the given books.
+
+    books is an iterable of (path, refs) pairs, where refs lists the
+    (book, chapter, verse label, start, end) of every verse in the file at
+    path. Books are named by book_name.
+    """
+
+    index = {}
+    files = {}
+    for path, refs in books:
+        for book, chapter, label, start, end in refs:
+            book = book_name(book, path, files)
+            entry = index.setdefault(book, {"file": path, "chapters": {}})
+            verses = entry["chapters"].setdefault(str(chapter), {})
+            if label in verses:
+                # A verse split over several places, keep the whole span
+                start = min(start, verses[label][0])
+                end = max(end, verses[label][1])
+            verses[label] = [start, end]
+    return index
+
+
+def write_index(index, path=index_file):
+    "Write the index to path, replacing any earlier one at once"
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+
+
+def parse_ref(line, chapter):
+    """Return the book, chapter and verse label of a verse line.
+
+    chapter is the current chapter. A line with only a book name starts
+    the next chapter, or has the chapter None if chapter is None, a verse
+    without a chapter is in chapter 1, and the prologue of Sirach is
+    chapter 0. The verse label may carry a letter, as in "35a".
+    """
+
+    items = line.split()
+    if len(items) == 1:
+        if chapter is None:
+            return items[0], None, "0"
+        return items[0], chapter + 1, "0"
+    if ":" not in items[1]:
+        return items[0], 1, items[1]
+    chapter, verse = items[1].split(":", 1)
+    if chapter == "Prolog":
+        return items[0], 0, verse
+    return items[0], int(chapter), verse
+
+
+def verse_number(label):
+    "Return the number of a verse label, without any letter after it"
+
+    digits = len(label) - len(label.lstrip("0123456789"))
+    return int(label[:digits] or 0)
+
+
+def nfc(text):
+    "Return text in NFC, skipping the work when it already is"
+
+    if unicodedata.is_normalized("NFC", text):
+        return text
+    return unicodedata.normalize("NFC", text)
+
+
+class LXXMIndex(object):
+    """Passage lookup through the verse reference index.
+
+    The index is loaded once, and each lookup is a dictionary access and a
+    single read of the byte range from the book's file.
+    """
+
+    def __init__(self, path=index_file):
+        with open(path) as f:
+            index = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        self._books = {}
+        for book, entry in index.items():
+            chapters = {}
+            for chapter, verses in entry["chapters"].items():
+                numbered = chapters.setdefault(int(chapter), {})
+                for label, (start, end) in verses.items():
+                    # Lettered verses fall within the range of their number
+                    span = numbered.setdefault(verse_number(label),
+                                               [start, end])
+                    span[0] = min(span[0], start)
+                    span[1] = max(span[1], end)
+            self._books[book] = (os.path.join(base, entry["file"]), chapters)
+        self._files = {}
+
+    def books(self):
+        "Return the names of the indexed books"
+
+        return list(self._books)
+
+    def verse_range(self, book, chapter, verse):
+        "Return the file and byte range of a verse, or raise KeyError"
+
+        path, chapters = self._books[book]
+        start, end = chapters[chapter][verse]
+        return path, start, end
+
+    def passage(self, book, chapter, verse, end_chapter=None, end_verse=None):
+        """Return the converted text from one verse through another.
+
+        Without end_chapter the passage ends in the same chapter, and
+        without end_verse it is the single verse. Raises KeyError for a
+        reference that is not in the index.
+        """
+
+        if end_chapter is None:
+            end_chapter = chapter
+        if end_verse is None:
+            end_verse = verse
+        path, start, end = self.verse_range(book, chapter, verse)
+        end = self.verse_range(book, end_chapter, end_verse)[2]
+        if end < start:
+            raise ValueError("Passage ends before it starts")
+        f = self._files.get(path)
+        if f is None:
+            f = self._files[path] = open(path, "rb")
+        f.seek(start)
+        return f.read(end - start).decode("utf-8")
+
+    def close(self):
+        "Close the book files opened by passage"
+
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+_default_index = None
+
+
+def passage(book, chapter, verse, end_chapter=None, end_verse=None):
+    """Return the converted text of a passage, using lxxm-index.json in the
+    current directory.
+
+    >>> print(passage("Isa", 40, 1, 40, 11))
+    """
+
+    global _default_index
+    if _default_index is None:
+        _default_index = LXXMIndex()
+    return _default_index.passage(book, chapter, verse, end_chapter,
+                                  end_verse)
@@ -0,0 +1,237 @@
+#
+# lxxm_store.py
+# Compact binary token store for the unicode LXXM, with random access by verse
+# (c) 2026 Nathan D. Smith <nathan@smithfam.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import bisect
+import collections
+import mmap
+import os
+import struct
+import sys
+
+# The store is a single file holding a fixed-width array of (book, chapter,
+# verse, form_id, morph_id, lemma_id) unsigned 32-bit integers for every
+# token, a table of verse keys sorted for binary search with the range of
+# tokens of each verse, and interned UTF-8 string tables for the book names,
+# forms, morph codes and lemmas. All integers are little-endian.
+#
+# Verses are numbered by their leading digits, so the lettered verses of the
+# LXX (such as 3 Kgdms 2:35a-o) share the number of the verse they follow.
+# Books are named as in the verse reference index of lxxm_index.py, so a book
+# name found in more than one file is named after its later files.
+
+magic = b"LXXMSTR1"
+# Magic, then the counts of tokens and verses, then the offset of the token
+# array, the verse tables and each string table
+header = struct.Struct("<8s9I")
+string_tables = ("books", "forms", "morphs", "lemmas")
+fields = 6
+
+Token = collections.namedtuple(
+    "Token", ["book", "chapter", "verse", "form", "morph", "lemma"])
+
+
+def verse_key(book_id, chapter, verse):
+    "Pack a reference into the integer the verse table is sorted by"
+
+    if chapter >= 1 << 10 or verse >= 1 << 10:
+        raise ValueError("Reference out of range: %d:%d" % (chapter, verse))
+    return (book_id << 20) | (chapter << 10) | verse
+
+
+def _uint32_array(values):
+    "Return the values as little-endian unsigned 32-bit bytes"
+
+    data = array.array("I", values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _string_table(strings):
+    "Return a table of count, end offsets and the UTF-8 bytes of strings"
+
+    blob = bytearray()
+    ends = []
+    for string in strings:
+        blob += string.encode("utf-8")
+        ends.append(len(blob))
+    blob += b"\0" * (-len(blob) % 4)
+    return _uint32_array([len(strings)] + ends) + bytes(blob)
+
+
+def write_store(path, tokens):
+    """Write a token store to path.
+
+    tokens is an iterable of (book, chapter, verse, form, morph, lemma)
+    tuples in text order, with the book given by name and chapter and verse
+    as integers. The store is written to a temporary file that then
+    replaces path.
+    """
+
+    ids = dict((table, {}) for table in string_tables)
+    rows = array.array("I")
+    verses = []
+    last_key = None
+    for token in tokens:
+        row = []
+        for table, value in zip(("books", None, None, "forms", "morphs",
+                                 "lemmas"), token):
+            if table:
+                value = ids[table].setdefault(value, len(ids[table]))
+            row.append(value)
+        key = verse_key(row[0], row[1], row[2])
+        if key != last_key:
+            verses.append([key, len(rows) // fields, None])
+            last_key = key
+        rows.extend(row)
+    count = len(rows) // fields
+    for i, verse in enumerate(verses):
+        verse[2] = verses[i + 1][1] if i + 1 < len(verses) else count
+    # Sort by key, keeping text order among repeats of the same verse
+    verses.sort(key=lambda verse: verse[0])
+
+    if sys.byteorder != "little":
+        rows.byteswap()
+    sections = [rows.tobytes(),
+                _uint32_array(verse[0] for verse in verses),
+                _uint32_array(n for verse in verses for n in verse[1:])]
+    sections += [_string_table(list(ids[table])) for table in string_tables]
+    offsets = []
+    position = header.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.pack(magic, count, len(verses), *offsets))
+        for section in sections:
+            f.write(section)
+    os.replace(tmp_path, path)
+
+
+class LXXMStore(object):
+    """Read-only, memory-mapped access to a token store.
+
+    Nothing is decoded until it is asked for: tokens come from the mapped
+    integer array and their strings from the mapped string tables.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        values = header.unpack_from(self._map)
+        if values[0] != magic:
+            raise ValueError("%s is not an LXXM token store" % path)
+        count, verse_count = values[1:3]
+        rows_at, keys_at, ranges_at = values[3:6]
+        self._view = view = memoryview(self._map)
+        self._rows = self._uint32s(view, rows_at, count * fields)
+        self._keys = self._uint32s(view, keys_at, verse_count)
+        self._ranges = self._uint32s(view, ranges_at, verse_count * 2)
+        self._tables = {}
+        for table, offset in zip(string_tables, values[6:]):
+            size = self._uint32s(view, offset, 1)[0]
+            ends = self._uint32s(view, offset + 4, size)
+            self._tables[table] = (offset + 4 * (size + 1), ends)
+        self.books = [self._string("books", i)
+                      for i in range(len(self._tables["books"][1]))]
+        self._book_ids = dict((book, i) for i, book in enumerate(self.books))
+
+    @staticmethod
+    def _uint32s(view, offset, count):
+        "Return count unsigned 32-bit integers of the map from offset"
+
+        if sys.byteorder != "little":
+            values = array.array("I")
+            values.frombytes(view[offset:offset + 4 * count])
+            values.byteswap()
+            return values
+        return view[offset:offset + 4 * count].cast("I")
+
+    def _string(self, table, i):
+        "Return string number i of the given table"
+
+        start, ends = self._tables[table]
+        begin = ends[i - 1] if i else 0
+        return str(self._map[start + begin:start + ends[i]], "utf-8")
+
+    def __len__(self):
+        return len(self._rows) // fields
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        "Release the memory map and the file"
+
+        views = [self._rows, self._keys, self._ranges]
+        views += [ends for start, ends in self._tables.values()]
+        for view in views + [self._view]:
+            if isinstance(view, memoryview):
+                view.release()
+        self._map.close()
+        self._file.close()
+
+    def ids(self, i):
+        "Return the raw integer row of token number i"
+
+        return tuple(self._rows[i * fields:(i + 1) * fields])
+
+    def token(self, i):
+        "Return token number i, with its strings"
+
+        book, chapter, verse, form, morph, lemma = self.ids(i)
+        return Token(self.books[book], chapter, verse,
+                     self._string("forms", form),
+                     self._string("morphs", morph),
+                     self._string("lemmas", lemma))
+
+    def tokens(self, start, end):
+        "Return the tokens numbered from start up to, not including, end"
+
+        return [self.token(i) for i in range(start, end)]
+
+    def verse_ranges(self, book, chapter, verse):
+        """Return the (start, end) token ranges of the given verse, which
+        is empty if the store has no such book or verse.
+        """
+
+        if book not in self._book_ids:
+            return []
+        key = verse_key(self._book_ids[book], chapter, verse)
+        i = bisect.bisect_left(self._keys, key)
+        ranges = []
+        while i < len(self._keys) and self._keys[i] == key:
+            ranges.append((self._ranges[2 * i], self._ranges[2 * i + 1]))
+            i += 1
+        return ranges
+
+    def verse(self, book, chapter, verse):
+        """Return the tokens of the given verse, which is empty if the store
+        has no such book or verse.
+        """
+
+        tokens = []
+        for start, end in self.verse_ranges(book, chapter, verse):
+            tokens.extend(self.tokens(start, end))
+        return tokens
@@ -1,4 +1,4 @@
-#! /usb/bin/env python3
+#! /usr/bin/env python3
 #
 # lxxm-corpus.py
 # Create a tagged NLTK corpus from the LXXM
@@ -18,55 +18,102 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import codecs
+import argparse
+import concurrent.futures
+import fnmatch
 import os
-import re
+import sys
+import traceback
 
+# The corpus cache and tag tables are shared with the SBLGNT corpus builder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'sblgnt-nltk'))
+import corpuscache
+from morphtags import lxxm_tags
 
-def convert(path):
-    "Convert the given file to an NLTK tagged corpus file."
+# Verse labels start with a capital Latin letter
+label_chars = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+
+def tag_token(line):
+    "Return the word/tag token of a word line"
+
+    fields = line.split()
+    return fields[0] + '/' + lxxm_tags[fields[1]]
+
+
+def tokens(lines):
+    "Yield the corpus tokens of the given lines one at a time"
 
-    if not os.path.exists('lxxm-corpus'):
-        os.mkdir('lxxm-corpus')
-    out_path = 'lxxm-corpus/' + path.rsplit('-', 1)[0]
-    print("Converting " + out_path)
-    tokens = []
-    f = codecs.open('source/' + path, encoding='utf-8')
-    lines = f.readlines()
-    f.close()
     for line in lines:
+        first = line[:1]
         # Handle verse lables
-        if re.match(r"^[A-Z]", line):
+        if first in label_chars:
             pass
         # Empty lines signify verse breaks, treat as sentence breaks
-        elif re.match(r"\n", line):
-            tokens.append("\n")
+        elif first == "\n":
+            yield "\n"
         else:
-            fields = line.split()
-            pos = fields[1][:3].replace('-', '')
-            parse = fields[1][3:].replace('-', '')
-            tag = pos
-            if len(parse) > 0:
-                tag += '-' + parse
-            token = fields[0] + '/' + tag
-            tokens.append(token)
-
-    text = ' '.join(tokens)
-    g = open(out_path, 'w')
-    g.write(text)
-    g.close()
+            yield tag_token(line)
+
+
+def convert(path):
+    "Convert the given file to an NLTK tagged corpus file."
+
+    out_path = 'lxxm-corpus/' + path.rsplit('-', 1)[0]
+    print("Converting " + out_path)
+    with open('source/' + path, encoding='utf-8') as f, \
+            open(out_path + '.tmp', 'w', encoding='utf-8',
+                 buffering=1 << 16) as g:
+        sep = ''
+        for token in tokens(f):
+            g.write(sep + token)
+            sep = ' '
+    os.replace(out_path + '.tmp', out_path)
+
+
+def _convert_worker(path):
+    "Convert one file in a worker process, returning any traceback"
+
+    try:
+        convert(path)
+    except Exception:
+        return traceback.format_exc()
+
 
 if __name__ == '__main__':
-    # Obtain list of files
-    paths = os.listdir('source/')
-    # Remove meta files
-    paths.remove('README-Unicode')
-    paths.remove('.git')
-    paths.remove('*Morph-Coding')
-    paths.remove('*ReadMe.Analysis')
-    paths.remove('0-readme.txt')
-    paths.remove('0-user-declaration.txt')
+    parser = argparse.ArgumentParser(
+        description="Create a tagged NLTK corpus in lxxm-corpus/ from the "
+        "lxxmorph-unicode files in source/")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of files to convert in parallel "
+                        "(0 uses every CPU)")
+    parser.add_argument("--pattern", default="[0-9][0-9]*",
+                        help="Glob pattern of the book files in source/, "
+                        "leaving out the meta files (default: %(default)s)")
+    args = parser.parse_args()
 
+    os.makedirs('lxxm-corpus', exist_ok=True)
+    # Obtain list of files
+    paths = [path for path in os.listdir('source/')
+             if fnmatch.fnmatch(path, args.pattern)
+             and os.path.isfile('source/' + path)]
     paths.sort()
-    for path in paths:
-        convert(path)
+    jobs = args.jobs or os.cpu_count()
+    if jobs == 1:
+        errors = map(_convert_worker, paths)
+    else:
+        # Largest first, so the longest books start right away
+        paths.sort(key=lambda path: os.path.getsize('source/' + path),
+                   reverse=True)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            errors = list(pool.map(_convert_worker, paths))
+    failed = []
+    for path, error in zip(paths, errors):
+        if error:
+            print("Failed to convert {}:\n{}".format(path, error))
+            failed.append(path)
+    if failed:
+        print("Failed to convert: " + ", ".join(sorted(failed)))
+        sys.exit(1)
+    print("Writing " + corpuscache.write_cache('lxxm-corpus'))
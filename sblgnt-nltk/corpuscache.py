@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+#
+# corpuscache.py
+# Precompiled cache of a tagged NLTK corpus, and a reader that loads it
+#
+# (c) 2026 Nathan D. Smith <nathan@smithfam.info>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+import pickle
+import struct
+
+# The cache of a corpus directory such as "sblgnt-corpus/" is the file
+# "sblgnt-corpus.cache" beside it, so it is not read as part of the corpus.
+# It starts with magic bytes and the offset and length of a pickled header
+# at the end of the file. In between is one pickled list of tagged sentences
+# for each file. The header lists the offset and length of each file's
+# sentences and the categories of each file from cats.txt.
+
+magic = b"NLTKTAG1"
+prefix = struct.Struct("<8sQQ")
+
+
+def cache_path(root):
+    "Return the path of the cache of the corpus in root"
+
+    return os.path.normpath(root) + ".cache"
+
+
+def str2tuple(token, sep="/"):
+    "Split a word/tag token as NLTK does, with the tag in upper case"
+
+    loc = token.rfind(sep)
+    if loc >= 0:
+        return (token[:loc], token[loc + len(sep):].upper())
+    return (token, None)
+
+
+def tagged_sents(text):
+    """Return the tagged sentences of the text of a corpus file, where each
+    sentence is ended by a newline. Empty sentences are left out.
+    """
+
+    sents = []
+    for line in text.split("\n"):
+        sent = [str2tuple(token) for token in line.split()]
+        if sent:
+            sents.append(sent)
+    return sents
+
+
+def read_categories(path):
+    "Return the categories of each file from a cats.txt file"
+
+    categories = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                items = line.split()
+                if items:
+                    categories[items[0]] = items[1:]
+    return categories
+
+
+def write_cache(root, fileids=None, cat_file="cats.txt"):
+    """Parse the tagged files of the corpus in root and write its cache.
+
+    Without fileids every file in root other than cat_file and README is
+    cached. Files are parsed one at a time, so only one is in memory.
+    """
+
+    if fileids is None:
+        fileids = sorted(name for name in os.listdir(root)
+                         if name not in (cat_file, "README")
+                         and not name.endswith(".tmp")
+                         and os.path.isfile(os.path.join(root, name)))
+    path = cache_path(root)
+    files = []
+    with open(path + ".tmp", "wb") as cache:
+        cache.write(prefix.pack(magic, 0, 0))
+        for fileid in fileids:
+            with open(os.path.join(root, fileid), encoding="utf-8") as f:
+                data = pickle.dumps(tagged_sents(f.read()),
+                                    pickle.HIGHEST_PROTOCOL)
+            files.append((fileid, cache.tell(), len(data)))
+            cache.write(data)
+        header = pickle.dumps({"files": files, "categories": read_categories(
+            os.path.join(root, cat_file))}, pickle.HIGHEST_PROTOCOL)
+        offset = cache.tell()
+        cache.write(header)
+        cache.seek(0)
+        cache.write(prefix.pack(magic, offset, len(header)))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class CachedTaggedCorpusReader(object):
+    """Reads a corpus from its cache, with the tagged_words, tagged_sents and
+    categories of NLTK's CategorizedTaggedCorpusReader.
+
+    Only the header is read when the reader is made. The sentences of each
+    file are loaded the first time they are asked for and kept after that.
+    """
+
+    def __init__(self, root):
+        self._path = cache_path(root)
+        with open(self._path, "rb") as f:
+            found, offset, length = prefix.unpack(f.read(prefix.size))
+            if found != magic:
+                raise ValueError("%s is not a corpus cache" % self._path)
+            f.seek(offset)
+            header = pickle.loads(f.read(length))
+        self._files = dict((fileid, (offset, size))
+                           for fileid, offset, size in header["files"])
+        self._fileids = [fileid for fileid, offset, size in header["files"]]
+        self._categories = header["categories"]
+        self._loaded = {}
+
+    def fileids(self, categories=None):
+        "Return the files of the corpus, or of the given categories"
+
+        if categories is None:
+            return list(self._fileids)
+        if isinstance(categories, str):
+            categories = [categories]
+        return [fileid for fileid in self._fileids
+                if set(categories) & set(self._categories.get(fileid, []))]
+
+    def categories(self, fileids=None):
+        "Return the categories of the corpus, or of the given files"
+
+        if fileids is None:
+            fileids = self._fileids
+        elif isinstance(fileids, str):
+            fileids = [fileids]
+        return sorted(set(category for fileid in fileids
+                          for category in self._categories.get(fileid, [])))
+
+    def _resolve(self, fileids, categories):
+        "Return the files asked for by fileids or categories"
+
+        if fileids is not None and categories is not None:
+            raise ValueError("Specify fileids or categories, not both")
+        if categories is not None:
+            return self.fileids(categories)
+        if fileids is None:
+            return self._fileids
+        if isinstance(fileids, str):
+            return [fileids]
+        return fileids
+
+    def _sents(self, fileid):
+        "Return the tagged sentences of one file, loading them if needed"
+
+        sents = self._loaded.get(fileid)
+        if sents is None:
+            offset, size = self._files[fileid]
+            with open(self._path, "rb") as f:
+                f.seek(offset)
+                sents = self._loaded[fileid] = pickle.loads(f.read(size))
+        return sents
+
+    def tagged_sents(self, fileids=None, categories=None):
+        "Return the sentences of the given files as lists of (word, tag)"
+
+        return [sent for fileid in self._resolve(fileids, categories)
+                for sent in self._sents(fileid)]
+
+    def tagged_words(self, fileids=None, categories=None):
+        "Return the (word, tag) tokens of the given files"
+
+        return [token for fileid in self._resolve(fileids, categories)
+                for sent in self._sents(fileid) for token in sent]
+
+    def sents(self, fileids=None, categories=None):
+        "Return the sentences of the given files as lists of words"
+
+        return [[word for word, tag in sent]
+                for sent in self.tagged_sents(fileids, categories)]
+
+    def words(self, fileids=None, categories=None):
+        "Return the words of the given files"
+
+        return [word for word, tag in self.tagged_words(fileids, categories)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write the cache of an existing tagged corpus directory")
+    parser.add_argument("root", help="Corpus directory, such as sblgnt-corpus")
+    args = parser.parse_args()
+    print("Wrote " + write_cache(args.root))
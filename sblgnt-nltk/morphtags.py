@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+#
+# morphtags.py
+# Morph code to NLTK tag tables shared by the SBLGNT and LXXM corpus builders
+#
+# (c) 2026 Nathan D. Smith <nathan@smithfam.info>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+
+def make_tag(pos, parse):
+    "Return the NLTK tag of a part of speech and parsing without dashes"
+
+    if len(parse) > 0:
+        return pos + '-' + parse
+    return pos
+
+
+def lxxm_tag(morph):
+    "Return the NLTK tag of an LXXM morph code such as N1M-ASM"
+
+    return make_tag(morph[:3].replace('-', ''), morph[3:].replace('-', ''))
+
+
+def sblgnt_tag(codes):
+    "Return the NLTK tag of a MorphGNT (ccat-pos, ccat-parse) pair"
+
+    pos, parse = codes
+    return make_tag(pos.strip('-'), parse.replace('-', ''))
+
+
+class TagTable(dict):
+    """Morph codes mapped to their NLTK tags.
+
+    A tag is built and interned the first time its code is looked up, so
+    every token with the same code shares one tag string and a repeat
+    lookup is a dictionary hit. There are only a few thousand codes.
+    """
+
+    def __init__(self, build):
+        dict.__init__(self)
+        self.build = build
+
+    def __missing__(self, code):
+        tag = self[code] = sys.intern(self.build(code))
+        return tag
+
+
+lxxm_tags = TagTable(lxxm_tag)
+sblgnt_tags = TagTable(sblgnt_tag)
+
+
+def read_lxxm_codes(paths):
+    "Return the morph codes of the word lines of lxxmorph-unicode files"
+
+    codes = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and not "A" <= line[0] <= "Z":
+                    codes.append(fields[1])
+    return codes
+
+
+def read_sblgnt_codes():
+    "Return the (ccat-pos, ccat-parse) pairs of every SBLGNT token"
+
+    import pysblgnt
+
+    return [(row["ccat-pos"], row["ccat-parse"]) for book_num in range(1, 28)
+            for row in pysblgnt.morphgnt_rows(book_num)]
+
+
+def bench(codes, build, table):
+    """Tag every code by building each tag and through the table, printing
+    the time and the memory blocks left allocated per token for each.
+    """
+
+    for name, tag in (("build", build), ("table", table.__getitem__)):
+        start = time.perf_counter()
+        tags = [tag(code) for code in codes]
+        seconds = time.perf_counter() - start
+        del tags
+        # Count the memory again without the tracing slowing the timing
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        tags = [tag(code) for code in codes]
+        blocks = sys.getallocatedblocks() - blocks
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%s: %.3fs, %.2f blocks and %.1f bytes per token"
+              % (name, seconds, blocks / len(tags), size / len(tags)))
+        del tags
+    print("%d tokens, %d distinct codes" % (len(codes), len(table)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare building tags for each token with the tag "
+        "tables, over LXXM files or the SBLGNT")
+    parser.add_argument("files", nargs="*",
+                        help="lxxmorph-unicode files (default: the SBLGNT "
+                        "through pysblgnt)")
+    args = parser.parse_args()
+    if args.files:
+        bench(read_lxxm_codes(args.files), lxxm_tag, lxxm_tags)
+    else:
+        bench(read_sblgnt_codes(), sblgnt_tag, sblgnt_tags)
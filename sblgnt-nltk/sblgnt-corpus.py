@@ -1,4 +1,4 @@
-#! /usb/bin/env python
+#! /usr/bin/env python3
 #
 # sblgnt-corpus.py
 # Create a tagged NLTK corpus from the SBLGNT
@@ -17,46 +17,102 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import concurrent.futures
 import os
+import sys
+import time
+import traceback
 
 import pysblgnt
 
-punctuation = [".", ",", ";", "\u00b7"]
+import corpuscache
+from morphtags import sblgnt_tags
 
+punctuation = [".", ",", ";", "\u00b7"]
 
-def convert(book_num):
-    "Convert the given file to an NLTK tagged corpus file."
 
-    if not os.path.exists('sblgnt-corpus'):
-        os.mkdir('sblgnt-corpus')
-
-    # Use the built-in filename function, but omit the leading path
-    book_path = pysblgnt.morphgnt_filename(book_num).split("/")[1]
-    out_path = 'sblgnt-corpus/' + book_path.rsplit('-', 1)[0]
-    print("Converting " + out_path)
-    tokens = []
+def tokens(book_num):
+    "Yield the corpus tokens of the given book one at a time."
 
     for line in pysblgnt.morphgnt_rows(book_num):
-        pos = line["ccat-pos"].strip('-')
-        parse = line["ccat-parse"].replace('-', '')
-        tag = pos
-        if len(parse) > 0:
-            tag += '-' + parse
-        token = line["word"] + '/' + tag
-        tokens.append(token)
+        yield line["word"] + '/' + sblgnt_tags[line["ccat-pos"],
+                                               line["ccat-parse"]]
         # Deal with punctuation
         if line["text"][-1] in punctuation:
             punct = line["text"][-1]
-            p_token = punct + '/' + punct
-            tokens.append(p_token)
+            yield punct + '/' + punct
             if punct != ",":
-                tokens.append("\n")
+                yield "\n"
+
+
+def convert(book_num):
+    """Convert the given file to an NLTK tagged corpus file, returning its
+    path and number of tokens.
+    """
+
+    # Use the built-in filename function, but omit the leading path
+    book_path = pysblgnt.morphgnt_filename(book_num).split("/")[1]
+    out_path = 'sblgnt-corpus/' + book_path.rsplit('-', 1)[0]
+    count = 0
+    with open(out_path + '.tmp', 'w', encoding='utf-8',
+              buffering=1 << 16) as g:
+        sep = ''
+        for token in tokens(book_num):
+            g.write(sep + token)
+            sep = ' '
+            count += 1
+    os.replace(out_path + '.tmp', out_path)
+    return out_path, count
+
+
+def _convert_worker(book_num):
+    """Convert one book in a worker process, returning the path, number of
+    tokens and seconds taken, or the traceback on failure.
+    """
+
+    start = time.perf_counter()
+    try:
+        out_path, count = convert(book_num)
+    except Exception:
+        return None, traceback.format_exc()
+    return (out_path, count, time.perf_counter() - start), None
 
-    text = ' '.join(tokens)
-    g = open(out_path, 'w')
-    g.write(text)
-    g.close()
 
 if __name__ == '__main__':
-    for book_num in range(27):
-        convert(book_num+1)
+    parser = argparse.ArgumentParser(
+        description="Create a tagged NLTK corpus of the SBLGNT in "
+        "sblgnt-corpus/")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of books to convert in parallel "
+                        "(0 uses every CPU)")
+    args = parser.parse_args()
+
+    os.makedirs('sblgnt-corpus', exist_ok=True)
+    book_nums = [book_num + 1 for book_num in range(27)]
+    jobs = args.jobs or os.cpu_count()
+    start = time.perf_counter()
+    if jobs == 1:
+        results = map(_convert_worker, book_nums)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_convert_worker, book_nums))
+    failed = []
+    total = 0
+    for book_num, (result, error) in zip(book_nums, results):
+        if error:
+            print("Failed to convert book {}:\n{}".format(book_num, error))
+            failed.append(str(book_num))
+            continue
+        out_path, count, seconds = result
+        total += count
+        print("Converted {}: {} tokens in {:.2f}s ({:.0f} tokens/s)".format(
+            out_path, count, seconds, count / seconds if seconds else 0))
+    seconds = time.perf_counter() - start
+    print("Converted {} books: {} tokens in {:.2f}s ({:.0f} tokens/s)".format(
+        len(book_nums) - len(failed), total, seconds,
+        total / seconds if seconds else 0))
+    if failed:
+        print("Failed to convert books: " + ", ".join(failed))
+        sys.exit(1)
+    print("Writing " + corpuscache.write_cache('sblgnt-corpus'))
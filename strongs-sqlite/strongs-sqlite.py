@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 #
 # Strongs XML to sqlite3 converter
 # Copyright (c) 2011, 2012 Nathan Smith <nathan@smithfam.info>
@@ -21,13 +21,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import argparse
+import collections
 import logging
 import os
 import sqlite3
-import StringIO
+import sys
+import time
+import urllib.request
 import xml.sax
 import zipfile
-import urllib
+
+import strongs_search
 
 
 hebrew_source = 'https://github.com/openscriptures/strongs/raw/master/hebrew/StrongHebrewG.xml'
@@ -35,12 +40,69 @@ greek_source = 'https://github.com/downloads/morphgnt/strongs-dictionary-xml/Str
 db_file = 'strongs.sqlite'
 log_file = 'strongs.log'
 
+# A strongsref in a Greek description whose entry was not yet loaded
+StrongsRef = collections.namedtuple("StrongsRef", ["number"])
+
+
+class EntryRecord():
+    """The fields of the entry being parsed.
+
+    The description is kept as the list of its fragments, as SAX hands them
+    over, and joined once when the entry is complete.
+    """
+
+    __slots__ = ("number", "lemma", "xlit", "pronounce", "parts", "refs")
+
+    def __init__(self):
+        self.number = ""
+        self.lemma = ""
+        self.xlit = ""
+        self.pronounce = ""
+        self.parts = []
+        self.refs = []
+
+    def add(self, text):
+        """Add a fragment of text to the description."""
+        self.parts.append(text)
+
+    def description(self):
+        """Return the description built so far."""
+        return "".join(self.parts)
+
+    def ends_with(self, suffix):
+        """Return whether the description so far ends with suffix."""
+        for part in reversed(self.parts):
+            if part:
+                return part.endswith(suffix)
+        return False
+
+
+class ConcatRecord(EntryRecord):
+    """An EntryRecord that adds each fragment to its description with +=,
+    as the handlers used to, for bench_hebrew."""
+
+    __slots__ = ("text",)
+
+    def __init__(self):
+        EntryRecord.__init__(self)
+        self.text = ""
+
+    def add(self, text):
+        self.text += text
+
+    def description(self):
+        return self.text
+
+    def ends_with(self, suffix):
+        return self.text.endswith(suffix)
+
+
 def download(url):
     """Download the given URL and return a path."""
     if not os.path.exists(os.path.basename(url)):
         logging.info("Retrieving %s" % url)
         try:
-            urllib.urlretrieve(url, os.path.basename(url))
+            urllib.request.urlretrieve(url, os.path.basename(url))
         except:
             logging.error("Failed to retrieve resource.")
             sys.exit(1)
@@ -50,93 +112,235 @@ def download(url):
 
 
 class StrongsDB():
-    """Class to handle database access for Strongs import"""
+    """Class to handle database access for Strongs import
+
+    Rows and derivation updates are queued and written in batches with
+    executemany, all in one transaction that ends with db_commit. The Greek
+    derivations are held until then, so that references to entries later in
+    the file can be resolved together.
+
+    With compact, entries go in a WITHOUT ROWID strongs_entry table keyed by
+    integer language and number codes, the strongsrefs of Greek entries go
+    in strongs_ref, and strongs is a view of strongs_entry with the usual
+    columns.
+    """
 
-    def __init__(self, db_file):
+    batch_size = 1000
+
+    def __init__(self, db_file, compact=False):
         """Initialize the database and instance vars."""
-        self.reset_vars()
+        self.compact = compact
+        self._rows = []
+        self._derivs = []
+        self._refs = []
+        # Lemma of each number added, for the derivation pass
+        self._lemmas = {}
+        self.lemma_hits = 0
+        self.lemma_misses = 0
+        self.lemma_deferred = 0
+        self.lemma_time = 0.0
         self._conn = sqlite3.connect(db_file)
         self._cursor = self._conn.cursor()
-        init_db_sql = "create table strongs (number text, lemma text, \
-            xlit text, pronounce text, description text)"
-        self._cursor.execute(init_db_sql)
-        self._conn.commit()
+        # The database is built in one go, so trade durability for speed
+        self._cursor.execute("pragma journal_mode = memory")
+        self._cursor.execute("pragma synchronous = off")
+        self._cursor.execute("pragma cache_size = -65536")
+        if not compact:
+            init_db_sql = "create table strongs (number text, lemma text, \
+                xlit text, pronounce text, description text)"
+            self._cursor.execute(init_db_sql)
+            return
+        self._cursor.execute("create table strongs_entry (lang integer, \
+            num integer, lemma text, xlit text, pronounce text, \
+            description text, primary key (lang, num)) without rowid")
+        self._cursor.execute("create table strongs_ref (lang integer, \
+            num integer, seq integer, ref_lang integer, ref_num integer, \
+            primary key (lang, num, seq)) without rowid")
+        self._cursor.execute("create view strongs as select %s as number, \
+            lemma, xlit, pronounce, description from strongs_entry"
+            % strongs_search.number_column())
+
+    def add_row(self, entry):
+        """Add a full row into the database, used for Hebrew."""
+        description = entry.description()
+        logging.debug("add_row_sql: %s|%s|%s|%s|%s", entry.number,
+            entry.lemma, entry.xlit, entry.pronounce, description)
+        self._rows.append((entry.number, entry.lemma, entry.xlit,
+            entry.pronounce, description))
+        self._lemmas.setdefault(entry.number, entry.lemma)
+        if len(self._rows) >= self.batch_size:
+            self.flush_rows()
+
+    def add_row_greek(self, entry):
+        """Add a partial line, lacking derivation, for Greek."""
+        logging.debug("add_row_sql: %s|%s|%s|%s", entry.number,
+            entry.lemma, entry.xlit, entry.pronounce)
+        self._rows.append((entry.number, entry.lemma, entry.xlit,
+            entry.pronounce, None))
+        self._lemmas.setdefault(entry.number, entry.lemma)
+        if len(self._rows) >= self.batch_size:
+            self.flush_rows()
+
+    def add_deriv(self, entry):
+        """Fill in the missing deriv field for Greek.
+
+        The entry's description parts are strings and the StrongsRef of any
+        lemmas still to be looked up. It is written by flush_derivs.
+        """
+        self._derivs.append((entry.parts, entry.number))
+
+    def add_refs(self, entry):
+        """Record the numbers of the strongsrefs of the entry, in order, for
+        the compact schema.
+        """
+        if self.compact:
+            self._refs.append((entry.number, entry.refs))
+
+    def flush_rows(self):
+        """Insert the queued rows."""
+        if self.compact:
+            # Only the first row of a number is kept, as get_lemma finds
+            add_row_sql = 'insert or ignore into strongs_entry \
+                values (?, ?, ?, ?, ?, ?)'
+            rows = (strongs_search.split_number(row[0]) + row[1:]
+                    for row in self._rows)
+        else:
+            add_row_sql = 'insert into strongs values (?, ?, ?, ?, ?)'
+            rows = self._rows
+        self._cursor.executemany(add_row_sql, rows)
+        self._rows = []
+
+    def flush_refs(self):
+        """Insert the queued strongsrefs of the compact schema."""
+        if not self._refs:
+            return
+        rows = []
+        for number, numbers in self._refs:
+            key = strongs_search.split_number(number)
+            for seq, ref in enumerate(numbers):
+                try:
+                    rows.append(key + (seq,)
+                                + strongs_search.split_number(ref))
+                except ValueError:
+                    logging.warning("Skipping strongsref %s of %s", ref,
+                                    number)
+        self._cursor.executemany("insert or ignore into strongs_ref \
+            values (?, ?, ?, ?, ?)", rows)
+        self._refs = []
+
+    def flush_derivs(self):
+        """Resolve the references of the queued derivations and apply them."""
+        self.flush_rows()
+        updates = []
+        for parts, number in self._derivs:
+            description = "".join(
+                part if isinstance(part, str) else self.get_lemma(part.number)
+                for part in parts).replace("\n", "")
+            logging.debug("updating %s with description: %s", number,
+                          description)
+            if self.compact:
+                updates.append((description,)
+                               + strongs_search.split_number(number))
+            else:
+                updates.append((description, number))
+        if self.compact:
+            ad_sql = "update strongs_entry set description = ? \
+                where lang = ? and num = ?"
+        else:
+            ad_sql = "update strongs set description = ? where number = ?"
+        self._cursor.executemany(ad_sql, updates)
+        self._derivs = []
+
+    def flush(self):
+        """Write all queued rows and updates to the database."""
+        self.flush_rows()
+        self.flush_refs()
+        self.flush_derivs()
+
+    def create_indexes(self):
+        """Index the loaded rows by number for the derivation updates.
+
+        The compact tables are keyed by number already. The strongsrefs are
+        indexed by their target, and the text number of the strongs view
+        is indexed so that lookups through the view are not scans either.
+        """
+        self.flush_rows()
+        if self.compact:
+            self.flush_refs()
+            self._cursor.execute("create index strongs_ref_target \
+                on strongs_ref (ref_lang, ref_num)")
+            self._cursor.execute("create index strongs_entry_number \
+                on strongs_entry (%s)" % strongs_search.number_column())
+        else:
+            self._cursor.execute("create index strongs_number \
+                on strongs (number)")
 
-    def reset_vars(self):
-        """Reset instance variables between db operations.
+    def find_lemma(self, number):
+        """Return the lemma of the given number if its row has been added.
 
-        Should be called after batches of add_row, add_row_greek, and
-        add_deriv.
+        Otherwise return None, for the lookup to be made again once every
+        row is in.
         """
-        self.number = ""
-        self.lemma = ""
-        self.xlit = ""
-        self.pronounce = ""
-        self.description = ""
-    
-    def add_row(self):
-        """Add a full row into the database, used for Hebrew."""
-        add_row_sql = 'insert into strongs values (?, ?, ?, ?, ?)' 
-        logging.debug("add_row_sql: %s|%s|%s|%s|%s" % (self.number, 
-            self.lemma, self.xlit, self.pronounce, self.description))
-        self._cursor.execute(add_row_sql, (self.number, self.lemma, self.xlit, 
-            self.pronounce, self.description,))
-        self.reset_vars()
-
-    def add_row_greek(self):
-        """Add a partial line, lacking derivation, for Greek."""
-        arg_sql = "insert into strongs (number, lemma, xlit, pronounce) values\
-            (?, ?, ?, ?)"
-        logging.debug("add_row_sql: %s|%s|%s|%s" % (self.number, 
-            self.lemma, self.xlit, self.pronounce))
-        self._cursor.execute(arg_sql, (self.number, self.lemma, self.xlit, 
-            self.pronounce,))
-        self.reset_vars()
-
-    def add_deriv(self):
-        """Fill in the missing deriv field for Greek."""
-        self.prepare_row()
-        ad_sql = "update strongs set description = ? where number = ?"
-        logging.debug("updating %s with description: %s" % (self.number,
-                                                      self.description))
-        self._cursor.execute(ad_sql, (self.description, self.number,))
-        self.reset_vars()
+        start = time.perf_counter()
+        lemma = self._lemmas.get(number)
+        if lemma is None:
+            self.lemma_deferred += 1
+        else:
+            self.lemma_hits += 1
+        self.lemma_time += time.perf_counter() - start
+        return lemma
 
     def get_lemma(self, number):
-        """Query the database for the given number and return the lemma.
+        """Return the lemma of the given number from the rows added so far.
 
         If the database does not have the lemma for that number, return the
-        number back instead.
+        number back instead. The first row added for a number wins, as with
+        a query of the table.
         """
-        gl_sql = "select lemma from strongs where number=?"
-        self._cursor.execute(gl_sql, (number,))
-        res = self._cursor.fetchone()
-        if not res:
+        start = time.perf_counter()
+        lemma = self._lemmas.get(number)
+        if lemma is None:
+            self.lemma_misses += 1
             lemma = number
         else:
-            lemma = res[0]
+            self.lemma_hits += 1
+        self.lemma_time += time.perf_counter() - start
         return lemma
 
-    def prepare_row(self):
-        self.description = self.description.replace("\n","")
+    def lemma_stats(self):
+        """Describe the lemma lookups made by get_lemma."""
+        lookups = self.lemma_hits + self.lemma_misses
+        rate = 100.0 * self.lemma_hits / lookups if lookups else 0.0
+        return "%d lemma lookups, %d hits, %d misses (%.1f%% hit rate), " \
+            "%d deferred to the end, in %.4fs" % (lookups, self.lemma_hits,
+            self.lemma_misses, rate, self.lemma_deferred, self.lemma_time)
+
+    def create_search(self):
+        """Add the normalized lemma and full-text search tables."""
+        self.flush()
+        return strongs_search.create_search(self._conn, self.compact)
 
     def db_commit(self):
         """Commit changes to the database."""
+        self.flush()
         self._conn.commit()
 
     def finish(self):
         """Close the database connection."""
         self._cursor.close()
+        self._conn.close()
 
 
 class StrongsHebrewParser(xml.sax.handler.ContentHandler):
     """Class to parse the Strongs Hebrew xml file."""
 
-    def __init__(self, db):
+    def __init__(self, db, record=EntryRecord):
         self.in_foreign = False
         self.note_depth = 0
         self.in_entry = False
         self.in_trans = False
+        self.record = record
+        self.entry = record()
         self.db = db
 
     def startElement(self, name, attrs):
@@ -150,20 +354,20 @@ class StrongsHebrewParser(xml.sax.handler.ContentHandler):
         if name == "div" and attrs.getValue("type") == "entry":
             self.in_entry = True
         if name == "w" and self.in_foreign == False and self.note_depth == 0:
-            self.db.number = attrs.getValue("ID")
-            self.db.lemma = attrs.getValue("lemma")
-            self.db.xlit = attrs.getValue("xlit")
-            self.db.pronounce = attrs.getValue("POS")
+            self.entry.number = attrs.getValue("ID")
+            self.entry.lemma = attrs.getValue("lemma")
+            self.entry.xlit = attrs.getValue("xlit")
+            self.entry.pronounce = attrs.getValue("POS")
         if name == "w" and self.note_depth > 0:
             if "lemma" in attrs.getNames():
-                self.db.description += attrs.getValue("lemma")
+                self.entry.add(attrs.getValue("lemma"))
             else:
-                self.db.description += attrs.getValue("POS")
+                self.entry.add(attrs.getValue("POS"))
 
     def characters(self, data):
         """Actions for characters within tags"""
         if self.note_depth > 0:
-            self.db.description += data
+            self.entry.add(data)
 
     def endElement(self, name):
         """Actions for closing tags."""
@@ -174,25 +378,34 @@ class StrongsHebrewParser(xml.sax.handler.ContentHandler):
             # If we exit a note completely, close the note types
             if self.note_depth == 0 and not self.in_trans:
                 # Add a space between entries when moving between notes
-                if self.db.description and self.db.description[-1] == ";":
-                    self.db.description += " "
+                if self.entry.ends_with(";"):
+                    self.entry.add(" ")
                 else:
-                    self.db.description += "; "
+                    self.entry.add("; ")
         if name == "div" and self.in_entry == True:
             # Commit to db when each word's div tag is closed
             # Have to differentiate the type, since there is a div supertag.
-            self.db.add_row()
+            self.db.add_row(self.entry)
+            self.entry = self.record()
             self.in_entry = False
             self.in_trans = False
 
 
 class StrongsGreekParser(xml.sax.handler.ContentHandler):
-    """Class to parse the Strongs Greek xml file."""
+    """Class to parse the Strongs Greek xml file.
+
+    Each entry's row is added along with its strongs_derivation, in which
+    strongsref lemmas are filled in from the rows loaded so far. References
+    to later entries are left for the db to resolve at the end.
+    """
 
     def __init__(self, db):
         self.in_entry = False
         self.in_strongs = False
+        self.in_desc = False
         self.greek_tag = 0
+        self.entry = EntryRecord()
+        self.number_parts = []
         self.db = db
 
     def startElement(self, name, attrs):
@@ -206,93 +419,177 @@ class StrongsGreekParser(xml.sax.handler.ContentHandler):
             # Corrects a bug in G1
             self.greek_tag += 1
             if self.greek_tag == 1:
-                self.db.lemma = attrs.getValue("unicode")
-                self.db.xlit = attrs.getValue("translit")
+                self.entry.lemma = attrs.getValue("unicode")
+                self.entry.xlit = attrs.getValue("translit")
         if name == "pronunciation":
-            self.db.pronounce = attrs.getValue("strongs")
-
-    def characters(self, data):
-        """Actions for characters within tags"""
-        if self.in_strongs:
-            self.db.number = "G%s" % data
-        
-    def endElement(self, name):
-        """Actions for closing tags."""
-        if name == "entry":
-            self.in_entry = False
-            self.greek_tag = 0
-            self.db.add_row_greek()
-        if name == "strongs":
-            self.in_strongs = False
-
-
-class StrongsG2Parser(xml.sax.handler.ContentHandler):
-    """Class to fill in strongs_derivation in Greek from db."""
-
-    def __init__(self, db):
-        self.in_desc = False
-        self.in_strongs = False
-        self.db = db
-
-    def startElement(self, name, attrs):
-        """Actions for opening tags."""
+            self.entry.pronounce = attrs.getValue("strongs")
         if name == "strongs_derivation":
             self.in_desc = True
-        if name == "strongs":
-            self.in_strongs = True
         if name == "strongsref":
             lang = attrs.getValue("language")
             num = attrs.getValue("strongs").lstrip("0")
             number = "%s%s" % (lang[0], num)
-            logging.debug("Querying strongsref %s for entry %s" % (number, 
-                self.db.number))
-            lemma = self.db.get_lemma(number)
-            self.db.description += lemma
+            logging.debug("Querying strongsref %s for entry %s", number,
+                self.entry.number)
+            self.entry.refs.append(number)
+            lemma = self.db.find_lemma(number)
+            if lemma is None:
+                self.entry.parts.append(StrongsRef(number))
+            else:
+                self.entry.parts.append(lemma)
 
     def characters(self, data):
         """Actions for characters within tags"""
         if self.in_desc:
-            self.db.description += data
+            self.entry.parts.append(data)
         if self.in_strongs:
-            self.db.number = "G%s" % data
+            # The number may come in more than one piece
+            self.number_parts.append(data)
 
     def endElement(self, name):
         """Actions for closing tags."""
         if name == "entry":
-            self.db.add_deriv()
-        if name == "entry":
+            self.in_entry = False
             self.in_desc = False
+            self.greek_tag = 0
+            self.db.add_deriv(self.entry)
+            self.db.add_refs(self.entry)
+            self.db.add_row_greek(self.entry)
+            self.entry = EntryRecord()
         if name == "strongs":
             self.in_strongs = False
+            if self.number_parts:
+                self.entry.number = "G%s" % "".join(self.number_parts)
+                self.number_parts = []
+
+
+class DescriptionCollector():
+    """Stands in for StrongsDB to keep the description of each parsed Hebrew
+    entry, for bench_hebrew."""
+
+    def __init__(self):
+        self.descriptions = []
+
+    def add_row(self, entry):
+        self.descriptions.append(entry.description())
+
+
+class CountingConcatRecord(ConcatRecord):
+    """A ConcatRecord that counts the strings its += builds and the
+    characters copied into them, for bench_hebrew."""
+
+    __slots__ = ()
+    strings = 0
+    chars = 0
+
+    def add(self, text):
+        before = self.text
+        ConcatRecord.add(self, text)
+        # Adding to or from "" hands back the other string without a copy
+        if self.text is not before and self.text is not text:
+            CountingConcatRecord.strings += 1
+            CountingConcatRecord.chars += len(self.text)
+
+
+class CountingRecord(EntryRecord):
+    """An EntryRecord that counts the strings joining its fragments builds
+    and the characters copied into them, for bench_hebrew."""
+
+    __slots__ = ()
+    strings = 0
+    chars = 0
+
+    def description(self):
+        text = EntryRecord.description(self)
+        if text and len(self.parts) > 1:
+            CountingRecord.strings += 1
+            CountingRecord.chars += len(text)
+        return text
+
+
+def parse_descriptions(hebrew_xml, record):
+    """Return the descriptions of the Hebrew XML, parsed with entries of the
+    given record class."""
+    collector = DescriptionCollector()
+    hebrew_parser = xml.sax.make_parser()
+    hebrew_parser.setContentHandler(StrongsHebrewParser(collector, record))
+    with open(hebrew_xml, "rb") as h:
+        hebrew_parser.parse(h)
+    return collector.descriptions
+
+
+def bench_hebrew(hebrew_xml):
+    """Parse the Hebrew XML without a database, adding each fragment of the
+    descriptions with +=, as the handlers used to, and joining them once,
+    printing the time of each and the strings built and characters copied
+    for the descriptions.
+    """
+    for name, record, counting in (("+=", ConcatRecord, CountingConcatRecord),
+                                   ("join", EntryRecord, CountingRecord)):
+        start = time.perf_counter()
+        descriptions = parse_descriptions(hebrew_xml, record)
+        seconds = time.perf_counter() - start
+        # Count on a second pass so the counting does not slow the timing
+        descriptions = parse_descriptions(hebrew_xml, counting)
+        print("%s: %.3fs, %d strings (%.1f per entry) copying %d characters"
+              % (name, seconds, counting.strings,
+                 counting.strings / len(descriptions), counting.chars))
+        del descriptions
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the Strongs XML files to a sqlite database")
+    parser.add_argument("--debug", action="store_true",
+                        help="Log every row to %s" % log_file)
+    parser.add_argument("--compact", action="store_true",
+                        help="Key entries by integer language and number in "
+                        "a WITHOUT ROWID table, with a strongs view and a "
+                        "table of strongsrefs")
+    parser.add_argument("--bench", action="store_true",
+                        help="Only time building the Hebrew descriptions "
+                        "with += and with join, counting the strings built")
+    args = parser.parse_args()
+    if args.bench:
+        bench_hebrew(download(hebrew_source))
+        sys.exit(0)
     # Configure log level here
-    logging.basicConfig(level=logging.DEBUG, filename=log_file)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        filename=log_file)
+    start = time.perf_counter()
     # Initialize the db here
-    db = StrongsDB(db_file)
+    db = StrongsDB(db_file, args.compact)
     # Parse the Hebrew here
     hebrew_xml = download(hebrew_source)
     logging.info("Parsing Hebrew XML")
     hebrew_parser = xml.sax.make_parser()
     hebrew_parser.setContentHandler(StrongsHebrewParser(db))
-    h = open(hebrew_xml)
+    h = open(hebrew_xml, "rb")
     hebrew_parser.parse(h)
     h.close()
-    db.db_commit()
+    logging.info("Parsed Hebrew XML at %.2fs", time.perf_counter() - start)
     # Parse the Greek here
     greek_zip = download(greek_source)
     logging.info("Parsing Greek XML")
     greek_parser = xml.sax.make_parser()
     greek_parser.setContentHandler(StrongsGreekParser(db))
-    _zip = zipfile.ZipFile(greek_zip)
-    greek_parser.parse(StringIO.StringIO(_zip.read("strongsgreek.xml")))
-    db.db_commit()
-    # Second pass on the Greek to retrieve missing lemmas in strongs_derivation
+    with zipfile.ZipFile(greek_zip) as _zip:
+        with _zip.open("strongsgreek.xml") as g:
+            greek_parser.parse(g)
+    logging.info("Parsed Greek XML at %.2fs", time.perf_counter() - start)
+    # Index once all the rows are loaded, before the derivation updates
+    db.create_indexes()
+    # Fill in the lemmas of strongsrefs to later entries, and the derivations
     logging.info("Finish Greek Strongs derivations")
-    g2_parser = xml.sax.make_parser()
-    g2_parser.setContentHandler(StrongsG2Parser(db))
-    g2_parser.parse(StringIO.StringIO(_zip.read("strongsgreek.xml")))
     db.db_commit()
+    logging.info("Derivations done at %.2fs: %s", time.perf_counter() - start,
+                 db.lemma_stats())
+    # Search tables, from the finished rows
+    if not db.create_search():
+        logging.warning("sqlite lacks FTS5, skipping the full-text table")
+    db.db_commit()
+    logging.info("Search tables done at %.2fs", time.perf_counter() - start)
+    db.finish()
     # All Done
-    logging.info("Finished. sqlite database at %s is ready." % db_file)
+    logging.info("Finished in %.2fs. sqlite database at %s is ready.",
+                 time.perf_counter() - start, db_file)
@@ -0,0 +1,289 @@
+#
+# strongs_lookup.py
+# Read-only, pooled and cached lookups of Strongs entries by number
+# Copyright (c) 2026 Nathan Smith <nathan@smithfam.info>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import collections
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import strongs_search
+
+StrongsEntry = collections.namedtuple(
+    "StrongsEntry", ["number", "lemma", "xlit", "pronounce", "description"])
+
+
+class StrongsLookup():
+    """Lookups of entries by number in a finished Strongs database.
+
+    The database is opened read-only and immutable, so sqlite takes no
+    locks and never checks it for changes: make a new StrongsLookup after
+    rebuilding it. Connections are kept in a pool of up to pool_size and
+    shared safely between threads. The entries of the last cache_size
+    numbers looked up, including numbers that are not in the database, are
+    kept in an LRU cache.
+    """
+
+    def __init__(self, db_file="strongs.sqlite", pool_size=4,
+                 cache_size=4096):
+        self._uri = "file:%s?mode=ro&immutable=1" % urllib.parse.quote(
+            os.path.abspath(db_file))
+        self._pool = queue.LifoQueue()
+        self._pool_size = pool_size
+        self._opened = 0
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.query_time = 0.0
+        self.query_max = 0.0
+        with self._connection() as conn:
+            compact = conn.execute("select count(*) from sqlite_master \
+                where name = 'strongs_entry'").fetchone()[0] > 0
+        self._compact = compact
+        self._sql = strongs_search.queries(compact)["number"]
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Borrow a connection from the pool, opening one if there are
+        fewer than pool_size, and waiting for one otherwise.
+
+        Raises sqlite3.ProgrammingError once the lookup is closed.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                new = self._opened < self._pool_size and not self._closed
+                if new:
+                    self._opened += 1
+            if new:
+                try:
+                    conn = sqlite3.connect(self._uri, uri=True,
+                                           check_same_thread=False)
+                except BaseException:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                conn = self._pool.get()
+        if conn is None:
+            # close() leaves None in the pool, pass it on to other waiters
+            self._pool.put(None)
+            raise sqlite3.ProgrammingError("The StrongsLookup is closed")
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _release(self, conn):
+        """Return a borrowed connection to the pool, or close it if the
+        lookup was closed meanwhile."""
+        with self._lock:
+            closed = self._closed
+            if closed:
+                self._opened -= 1
+            else:
+                self._pool.put(conn)
+        if closed:
+            conn.close()
+
+    def _cached(self, number):
+        """Return (True, entry) for a cached number, or (False, None)."""
+        with self._lock:
+            if number in self._cache:
+                self._cache.move_to_end(number)
+                self.hits += 1
+                return True, self._cache[number]
+            self.misses += 1
+        return False, None
+
+    def _store(self, number, entry):
+        """Cache the entry of a number, dropping the least recently used."""
+        if self._cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[number] = entry
+            self._cache.move_to_end(number)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _query(self, conn, numbers):
+        """Return the entries of numbers, or None for those not found, with
+        one index lookup each on a single connection."""
+        entries = []
+        start = time.perf_counter()
+        for number in numbers:
+            if self._compact:
+                try:
+                    key = strongs_search.split_number(number)
+                except ValueError:
+                    entries.append(None)
+                    continue
+            else:
+                key = (number,)
+            row = conn.execute(self._sql, key).fetchone()
+            entries.append(StrongsEntry(*row) if row else None)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.queries += 1
+            self.query_time += elapsed
+            self.query_max = max(self.query_max, elapsed)
+        return entries
+
+    def lookup(self, number):
+        """Return the StrongsEntry of a number like "G3056", or None."""
+        return self.lookup_many([number])[number]
+
+    def _split(self, numbers):
+        """Return the entries of the cached numbers as a dict, and a list
+        of the other numbers."""
+        found = {}
+        wanted = []
+        seen = set()
+        for number in numbers:
+            if number in seen:
+                continue
+            seen.add(number)
+            cached, entry = self._cached(number)
+            if cached:
+                found[number] = entry
+            else:
+                wanted.append(number)
+        return found, wanted
+
+    def _fetch(self, numbers):
+        """Look up numbers on one connection, caching and returning their
+        entries as a dict."""
+        with self._connection() as conn:
+            entries = self._query(conn, numbers)
+        for number, entry in zip(numbers, entries):
+            self._store(number, entry)
+        return dict(zip(numbers, entries))
+
+    def lookup_many(self, numbers):
+        """Return a dict of the StrongsEntry, or None, of each number.
+
+        Numbers not in the cache are looked up together on one connection.
+        """
+        found, wanted = self._split(numbers)
+        if wanted:
+            found.update(self._fetch(wanted))
+        return found
+
+    def lemma(self, number):
+        """Return the lemma of a number, or the number if it is not found,
+        as strongs-sqlite.py does for derivations."""
+        entry = self.lookup(number)
+        return entry.lemma if entry else number
+
+    def gloss(self, number):
+        """Return the description of a number, or None."""
+        entry = self.lookup(number)
+        return entry.description if entry else None
+
+    def stats(self):
+        """Return the cache and query counters as a dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"cache_hits": self.hits,
+                    "cache_misses": self.misses,
+                    "cache_hit_rate": self.hits / lookups if lookups else 0.0,
+                    "cache_entries": len(self._cache),
+                    "queries": self.queries,
+                    "query_seconds_total": self.query_time,
+                    "query_seconds_max": self.query_max,
+                    "connections": self._opened}
+
+    def metrics(self, prefix="strongs_lookup"):
+        """Return the stats in the Prometheus text format, for scraping."""
+        return "".join("%s_%s %r\n" % (prefix, name, value)
+                       for name, value in sorted(self.stats().items()))
+
+    def close(self):
+        """Close the pooled connections.
+
+        Connections still borrowed are closed when they are returned, and
+        later lookups of numbers that are not cached raise
+        sqlite3.ProgrammingError.
+        """
+        conns = []
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            while True:
+                try:
+                    conns.append(self._pool.get_nowait())
+                except queue.Empty:
+                    break
+            self._opened -= len(conns)
+            self._pool.put(None)
+        for conn in conns:
+            conn.close()
+
+
+class AsyncStrongsLookup():
+    """asyncio facade of a StrongsLookup.
+
+    Cached numbers are answered at once. Queries run in the loop's default
+    executor, or the given one, so they never block the event loop.
+    """
+
+    def __init__(self, lookup, executor=None):
+        self.lookup_service = lookup
+        self._executor = executor
+
+    async def lookup_many(self, numbers):
+        """Return a dict of the StrongsEntry, or None, of each number."""
+        found, wanted = self.lookup_service._split(numbers)
+        if wanted:
+            loop = asyncio.get_running_loop()
+            found.update(await loop.run_in_executor(
+                self._executor, self.lookup_service._fetch, wanted))
+        return found
+
+    async def lookup(self, number):
+        """Return the StrongsEntry of a number, or None."""
+        return (await self.lookup_many([number]))[number]
+
+    async def lemma(self, number):
+        """Return the lemma of a number, or the number if it is not found."""
+        entry = await self.lookup(number)
+        return entry.lemma if entry else number
+
+    async def gloss(self, number):
+        """Return the description of a number, or None."""
+        entry = await self.lookup(number)
+        return entry.description if entry else None
+
+    def stats(self):
+        """Return the stats of the underlying lookup."""
+        return self.lookup_service.stats()
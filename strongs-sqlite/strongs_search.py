@@ -0,0 +1,193 @@
+#
+# strongs_search.py
+# Lemma, transliteration and full-text search of the Strongs sqlite database
+# Copyright (c) 2026 Nathan Smith <nathan@smithfam.info>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sqlite3
+import unicodedata
+
+# strongs-sqlite.py adds these to the strongs table it builds:
+#
+#   strongs_plain  the key of each row with its lemma and transliteration
+#                  normalized by plain(), each indexed
+#   strongs_fts    an FTS5 table of the key and the plain lemma, xlit,
+#                  pronounce and description of each row
+#
+# FTS5's own diacritic removal only covers Latin letters, so the text is
+# normalized before it is indexed and queries are normalized the same way.
+#
+# The key is the text number, or with the compact schema the integer
+# language and number of the strongs_entry table, so that the lookups use
+# its primary key rather than the strongs view.
+
+# Language of each code of the compact schema
+languages = "HG"
+
+
+def split_number(number):
+    """Return the integer (language, number) key of a number like "G3056".
+
+    Raises ValueError if it is not of that form.
+    """
+
+    lang = languages.find(number[:1])
+    if lang < 0 or not number[1:].isdigit():
+        raise ValueError("Not a Strongs number: %r" % number)
+    return lang, int(number[1:])
+
+
+def number_column(prefix=""):
+    "Return the SQL that makes the text number from the compact key"
+
+    return "substr('%s', %slang + 1, 1) || %snum" % (languages, prefix, prefix)
+
+
+def queries(compact=False):
+    "Return the statements of StrongsSearch for the given schema"
+
+    if compact:
+        table, key, match = "strongs_entry", "lang, num", "lang = ? and num = ?"
+        number = number_column
+    else:
+        table, key, match = "strongs", "number", "number = ?"
+        number = lambda prefix="": prefix + "number"
+
+    def columns(prefix=""):
+        return ", ".join([number(prefix)] + [prefix + column for column in
+                         ("lemma", "xlit", "pronounce", "description")])
+
+    def plain_match(where):
+        return "select %s from %s where (%s) in \
+            (select %s from strongs_plain where %s)" % (columns(), table, key,
+                                                          key, where)
+
+    return {"number": "select %s from %s where %s" % (columns(), table, match),
+            "lemma": plain_match("lemma = ?"),
+            "xlit": plain_match("xlit = ?"),
+            "prefix": plain_match("lemma >= ? and lemma < ?"),
+            "search": "select %s from strongs_fts f join %s s using (%s) \
+                where strongs_fts match ? order by f.rank limit ?"
+                      % (columns("s."), table, key)}
+
+
+def plain(text):
+    """Return text without accents, breathings, vowel points or cantillation,
+    and in lower case, for matching regardless of them.
+    """
+
+    if text is None:
+        return None
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(c for c in decomposed
+                   if not unicodedata.combining(c)).casefold()
+
+
+def create_search(conn, compact=False):
+    """Add the normalized lemma table and the FTS5 table to the database of
+    the given connection, from its strongs table or, with the compact
+    schema, its strongs_entry table.
+
+    Returns False without the FTS5 table if sqlite was built without FTS5.
+    """
+
+    if compact:
+        table, key = "strongs_entry", "lang, num"
+        key_columns, fts_key = "lang integer, num integer", \
+            "lang unindexed, num unindexed"
+    else:
+        table, key = "strongs", "number"
+        key_columns, fts_key = "number text", "number unindexed"
+    conn.create_function("plain", 1, plain, deterministic=True)
+    conn.execute("create table strongs_plain (%s, lemma text, xlit text)"
+                 % key_columns)
+    conn.execute("insert into strongs_plain \
+        select %s, plain(lemma), plain(xlit) from %s" % (key, table))
+    conn.execute("create index strongs_plain_lemma on strongs_plain (lemma)")
+    conn.execute("create index strongs_plain_xlit on strongs_plain (xlit)")
+    try:
+        conn.execute("create virtual table strongs_fts using fts5(\
+            %s, lemma, xlit, pronounce, description)" % fts_key)
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("insert into strongs_fts select %s, plain(lemma), \
+        plain(xlit), plain(pronounce), plain(description) from %s"
+                 % (key, table))
+    conn.execute("insert into strongs_fts (strongs_fts) values ('optimize')")
+    return True
+
+
+class StrongsSearch():
+    """Searches of a Strongs database built by strongs-sqlite.py.
+
+    Each search runs one fixed statement with parameters, which sqlite
+    prepares once per connection and keeps in its statement cache. Rows
+    are (number, lemma, xlit, pronounce, description) tuples with either
+    schema.
+    """
+
+    def __init__(self, db_file="strongs.sqlite"):
+        self._conn = sqlite3.connect("file:%s?mode=ro" % db_file, uri=True)
+        self.compact = self._conn.execute("select count(*) from sqlite_master \
+            where name = 'strongs_entry'").fetchone()[0] > 0
+        self._sql = queries(self.compact)
+
+    def number(self, number):
+        """Return the row of the given number, such as "G3056", or None."""
+        if self.compact:
+            try:
+                key = split_number(number)
+            except ValueError:
+                return None
+        else:
+            key = (number,)
+        return self._conn.execute(self._sql["number"], key).fetchone()
+
+    def lemma(self, lemma):
+        """Return the rows whose lemma matches, ignoring accents and case."""
+        return self._conn.execute(self._sql["lemma"],
+                                  (plain(lemma),)).fetchall()
+
+    def xlit(self, xlit):
+        """Return the rows whose transliteration matches, ignoring accents
+        and case."""
+        return self._conn.execute(self._sql["xlit"], (plain(xlit),)).fetchall()
+
+    def lemma_prefix(self, prefix):
+        """Return the rows whose lemma starts with prefix, ignoring accents
+        and case."""
+        prefix = plain(prefix)
+        return self._conn.execute(self._sql["prefix"],
+                                  (prefix, prefix + "\U0010ffff")).fetchall()
+
+    def search(self, words, limit=20):
+        """Return the best rows, up to limit, containing all the given words
+        in any of their text.
+        """
+        terms = " ".join('"%s"' % word.replace('"', '""')
+                         for word in plain(words).split())
+        if not terms:
+            return []
+        return self._conn.execute(self._sql["search"],
+                                  (terms, limit)).fetchall()
+
+    def close(self):
+        """Close the database connection."""
+        self._conn.close()